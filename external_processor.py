@@ -1,8 +1,77 @@
 import argparse
+import collections
+import contextlib
+import glob
+import hashlib
 import json
+import math
+import os
+import queue
+import secrets
+import shutil
+import socket
+import sqlite3
 import sys
+import threading
+import time
+
+# Marks the end of a stream flowing between pipeline stages.
+_END = object()
+
+# Georeferenced detection boxes as they move through post-processing.
+# px/py is the box centre in raster pixels and `interior` marks boxes that
+# touch no neighbouring tile (see BucketedNMS).
+BOX_FIELDS = [
+    ('x1', '<f8'), ('y1', '<f8'), ('x2', '<f8'), ('y2', '<f8'),
+    ('confidence', '<f4'), ('class_id', '<i4'),
+    ('px', '<f8'), ('py', '<f8'), ('interior', '?'),
+]
+
+# Record layout of the raw detection file written with --raw-file:
+# georeferenced boxes above the floor confidence, before any NMS across
+# tiles, so that thresholds can be re-applied without re-running the model.
+RAW_FIELDS = [
+    ('x1', '<f8'), ('y1', '<f8'), ('x2', '<f8'), ('y2', '<f8'),
+    ('confidence', '<f4'), ('class_id', '<i4'),
+]
+
+# Record layout of the binary result file written with --result-file.
+DETECTION_FIELDS = [('x', '<f8'), ('y', '<f8'), ('confidence', '<f4'), ('class_id', '<i4')]
+RESULT_CHUNK_SIZE = 65536
+
+# Vector formats written with --output, by file extension.
+OUTPUT_DRIVERS = {'.gpkg': 'GPKG', '.fgb': 'FlatGeobuf'}
+OUTPUT_LAYER = 'detections'
+
+# Files picked up when --input names a directory.
+RASTER_EXTENSIONS = ('.tif', '.tiff', '.vrt', '.jp2', '.img')
+
+TILE_SIZE = 640
+OVERLAP = 100
+
+# Checkpointed tiles handed to post-processing at a time when resuming.
+RESUME_BATCH_SIZE = 64
+
+# Checkpoints not written to for this many seconds are deleted when a run starts.
+CHECKPOINT_MAX_AGE = 7 * 24 * 3600
+
+# Percentile of box sizes that sets the overlap search cells; larger boxes are searched separately.
+CELL_PERCENTILE = 99
+
+def process_for_yolo(image_np, cv2, np, convert=None):
+    """Turns a (bands, rows, cols) tile into the 3-band uint8 BGR image YOLO expects.
+
+    `convert` is a Uint8Converter holding raster-wide statistics; without
+    one, non-uint8 tiles are scaled by their own maximum.
+    """
+    if convert is not None and image_np.dtype != np.uint8:
+        # Converted band by band while still contiguous, then interleaved
+        # straight into BGR order.
+        bands = convert(image_np[:3], np)
+        if len(bands) == 3:
+            return cv2.merge([bands[2], bands[1], bands[0]])
+        return bands.transpose(1, 2, 0)
 
-def process_for_yolo(image_np, cv2, np):
     img = image_np.transpose(1, 2, 0)
     if img.shape[2] > 3:
         img = img[:, :, :3]
@@ -16,89 +85,1673 @@ def process_for_yolo(image_np, cv2, np):
             img = img.astype(np.uint8)
     return img
 
-def main(args):
+class Uint8Converter:
+    """Maps non-uint8 pixels to uint8 with one linear stretch for the whole raster.
+
+    The stretch runs from zero (or the lowest band percentile, for data
+    that goes negative) to the highest per-band high percentile. Sharing
+    one range across bands keeps the colour balance, and sharing it across
+    tiles keeps brightness from jumping at tile edges. 8 and 16-bit
+    integer data is converted with a lookup table; anything else is scaled
+    in place in float32.
+    """
+
+    def __init__(self, lo, hi, dtype, np):
+        self.lo = float(lo)
+        self.scale = 255.0 / (hi - lo) if hi > lo else 0.0
+        self.dtype = dtype = np.dtype(dtype)
+        self.lut = None
+        if dtype.kind in 'iu' and dtype.itemsize <= 2:
+            # Every possible value, in the order its bit pattern indexes the table.
+            values = np.arange(2 ** (8 * dtype.itemsize), dtype='u%d' % dtype.itemsize).view(dtype)
+            self.lut = self.stretch(values.astype(np.float32), np)
+
+    @classmethod
+    def from_sample(cls, sample, np, percentiles=(0.1, 99.9)):
+        """Builds the converter from a (bands, rows, cols) sample; masked pixels are ignored."""
+        bands = [np.ma.compressed(band) if np.ma.isMaskedArray(band) else band.ravel() for band in sample[:3]]
+        bands = [band[np.isfinite(band)] if band.dtype.kind == 'f' else band for band in bands]
+        stats = np.array([np.percentile(band, percentiles) for band in bands if band.size])
+        if not len(stats):
+            return cls(0, 0, sample.dtype, np)
+        return cls(min(0.0, stats[:, 0].min()), stats[:, 1].max(), sample.dtype, np)
+
+    @classmethod
+    def from_dataset(cls, src, indexes, np, max_size=1024):
+        """Samples a decimated read of the given bands, which GDAL serves from overviews when present."""
+        factor = max(1.0, max(src.width, src.height) / max_size)
+        out_shape = (len(indexes), max(1, int(src.height / factor)), max(1, int(src.width / factor)))
+        return cls.from_sample(src.read(indexes, out_shape=out_shape, masked=True), np)
+
+    def stretch(self, img, np):
+        """Scales a float array in place and returns it as uint8."""
+        np.subtract(img, self.lo, out=img)
+        np.multiply(img, self.scale, out=img)
+        np.clip(img, 0, 255, out=img)
+        if img.dtype.kind == 'f':
+            np.nan_to_num(img, copy=False)
+        return img.astype(np.uint8)
+
+    def __call__(self, img, np):
+        """Converts an image; float images are overwritten in place."""
+        if self.lut is not None and img.dtype == self.dtype:
+            return np.take(self.lut, img.view('u%d' % img.dtype.itemsize))
+        if img.dtype not in (np.float32, np.float64):
+            img = img.astype(np.float32)
+        return self.stretch(img, np)
+
+class TileReader:
+    """Reads tiles straight into interleaved BGR buffers and prepares them for the model.
+
+    Only the bands the model sees are read, already in BGR order, through a
+    (rows, cols, bands) view of a reusable buffer so that GDAL does the
+    interleaving. uint8 tiles then go to the model as they are.
+
+    With `scale` > 1 the raster is read decimated, `scale` source pixels
+    to a tile pixel, so that GDAL serves tiles from overviews where it
+    can. Tile offsets, `size` and `transform` are then in the coarser
+    pixels.
+    """
+
+    def __init__(self, tile_size, indexes, dtype, convert=None, scale=1.0):
+        self.tile_size = tile_size
+        self.indexes = indexes
+        self.dtype = dtype
+        self.convert = convert
+        self.scale = scale
+
+    def new_buffer(self, np):
+        return np.empty((self.tile_size, self.tile_size, len(self.indexes)), dtype=self.dtype)
+
+    def size(self, src):
+        """(width, height) of `src` in tile pixels."""
+        if self.scale == 1:
+            return src.width, src.height
+        return math.ceil(src.width / self.scale), math.ceil(src.height / self.scale)
+
+    def transform(self, src):
+        """Geotransform of tile pixels."""
+        if self.scale == 1:
+            return src.transform
+        from affine import Affine
+        return src.transform * Affine.scale(self.scale)
+
+    def read(self, src, x, y, buffer, rasterio):
+        """Reads the tile at (x, y) into `buffer` and returns the view holding it."""
+        width, height = self.size(src)
+        rows = min(self.tile_size, height - y)
+        cols = min(self.tile_size, width - x)
+        tile = buffer[:rows, :cols]
+        if self.scale == 1:
+            src.read(self.indexes, window=rasterio.windows.Window(x, y, cols, rows), out=tile.transpose(2, 0, 1))
+            return tile
+
+        s = self.scale
+        window = rasterio.windows.Window(x * s, y * s, min(cols * s, src.width - x * s), min(rows * s, src.height - y * s))
+        src.read(self.indexes, window=window, out=tile.transpose(2, 0, 1), resampling=rasterio.enums.Resampling.average)
+        return tile
+
+    def prepare(self, tile, np):
+        """Returns the uint8 image for the model; only non-uint8 tiles are copied."""
+        if tile.dtype == np.uint8:
+            return tile
+        if self.convert is not None:
+            return self.convert(tile, np)
+        max_val = np.max(tile)
+        if max_val > 0:
+            return (tile / max_val * 255).astype(np.uint8)
+        return tile.astype(np.uint8)
+
+def band_indexes(src, bands):
+    """Returns the 1-based band indexes to read, in BGR order.
+
+    `bands` lists the red, green and blue bands; by default the first three
+    bands (or all of them, for rasters with fewer) are used.
+    """
+    bands = bands or list(range(1, min(src.count, 3) + 1))
+    for band in bands:
+        if not 1 <= band <= src.count:
+            raise ValueError(f"Band {band} does not exist; the raster has {src.count} bands")
+    return bands[::-1]
+
+class BufferPool:
+    """A fixed set of tile buffers handed from the reader to inference and back.
+
+    Running out of buffers blocks the reader, which bounds memory just like
+    the queues do.
+    """
+
+    def __init__(self, count, new_buffer):
+        self.free = queue.Queue()
+        self.owned = set()
+        for _ in range(count):
+            buffer = new_buffer()
+            self.owned.add(id(buffer))
+            self.free.put(buffer)
+
+    def acquire(self, stop):
+        """Returns a free buffer, or None once the pipeline is stopped."""
+        while not stop.is_set():
+            try:
+                return self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def release(self, tile):
+        """Returns the buffer behind `tile` to the pool; arrays not from the pool are ignored."""
+        buffer = tile if tile.base is None else tile.base
+        if id(buffer) in self.owned:
+            self.free.put(buffer)
+
+class TileGrid:
+    """Layout of overlapping square tiles over a raster of width x height pixels.
+
+    `valid` optionally flags, per (row, col), the tiles worth reading;
+    the others are skipped by `offsets()`.
+    """
+
+    def __init__(self, width, height, tile_size, overlap):
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.step = tile_size - overlap
+        self.cols = len(range(0, width, self.step))
+        self.rows = len(range(0, height, self.step))
+        self.valid = None
+
+    def __len__(self):
+        if self.valid is not None:
+            return int(self.valid.sum())
+        return self.rows * self.cols
+
+    def tiles_in_row(self, row):
+        if self.valid is not None:
+            return int(self.valid[row].sum())
+        return self.cols
+
+    def offsets(self):
+        for y in range(0, self.height, self.step):
+            for x in range(0, self.width, self.step):
+                if self.valid is None or self.valid[y // self.step, x // self.step]:
+                    yield x, y
+
+    def row_of(self, y):
+        return y // self.step
+
+    def interior(self, xyxy, x0, y0):
+        """Flags tile-local boxes of the tile at (x0, y0) that touch no neighbouring tile.
+
+        The left/top neighbour ends `overlap` pixels into this tile and the
+        right/bottom neighbour starts `step` pixels into it.
+        """
+        inside = (xyxy[:, 0] >= self.overlap) | (x0 == 0)
+        inside &= (xyxy[:, 1] >= self.overlap) | (y0 == 0)
+        inside &= (xyxy[:, 2] <= self.step) | (x0 + self.step >= self.width)
+        inside &= (xyxy[:, 3] <= self.step) | (y0 + self.step >= self.height)
+        return inside
+
+    def segment(self, p, np):
+        """Segment index along one axis: 2k for the strip shared by tiles k - 1 and k, 2k + 1 for the core of tile k."""
+        k = np.floor_divide(p, self.step)
+        return (2 * k + (p - k * self.step >= self.overlap)).astype(np.int64)
+
+def model_gsd(model_path):
+    """Ground sample distance in metres the model was trained at, from a `<model>.json` sidecar.
+
+    The sidecar holds e.g. {"gsd": 0.1}. Returns None without one.
+    """
+    try:
+        with open(os.path.splitext(model_path)[0] + '.json', 'r', encoding='utf-8') as f:
+            return float(json.load(f)['gsd'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def resample_scale(src, target_gsd):
+    """Source pixels per model pixel when reading `src` at `target_gsd` metres.
+
+    Returns 1 (native resolution) without a target, for rasters without a
+    projected CRS, and for rasters already as coarse as the target: the
+    raster is decimated but never upsampled.
+    """
+    if not target_gsd or src.crs is None or not src.crs.is_projected:
+        return 1.0
+    t = src.transform
+    gsd = math.sqrt(abs(t.a * t.e - t.b * t.d))
+    try:
+        gsd *= src.crs.linear_units_factor[1]
+    except Exception:
+        pass
+    scale = target_gsd / gsd
+    return scale if scale > 1.01 else 1.0
+
+def aligned_overlap(block_shape, tile_size, overlap):
+    """Widens `overlap` so that the tile step is a whole number of blocks.
+
+    Every tile then starts on a block boundary, so each tile decodes the
+    fewest blocks when the block cache is too small to hold a strip of
+    tiles. Block dimensions larger than the step, such as the rows of a
+    striped TIFF, are ignored.
+    """
+    step = tile_size - overlap
+    unit = 1
+    for size in block_shape:
+        if size <= step:
+            unit = unit * size // math.gcd(unit, size)
+    aligned = step // unit * unit
+    return tile_size - aligned if aligned else overlap
+
+def gdal_options(args, rasterio, np):
+    """GDAL configuration for reading the input: decoding threads and block cache size.
+
+    Tiles overlap and do not line up with blocks, so most blocks are read
+    by several tiles, some of them a whole tile row later. By default the
+    cache holds a strip of tiles plus one block row across the whole
+    raster (every band, since pixel-interleaved blocks are decoded whole)
+    so that each block is decoded only once. Shard workers each get an
+    equal share of that, so the total stays within the same bound.
+    """
+    threads = args.gdal_threads or max(1, (os.cpu_count() or 1) // max(1, args.workers))
+    cache_mb = args.gdal_cache
+    if not cache_mb:
+        with rasterio.open(args.input) as src:
+            block_rows = src.block_shapes[0][0] if src.block_shapes else 0
+            itemsize = max(np.dtype(dtype).itemsize for dtype in src.dtypes)
+            strip = (TILE_SIZE + min(block_rows, src.height)) * src.width * src.count * itemsize
+        cache_mb = int(min(max(1.25 * strip / 2 ** 20, 256), 2048) / max(1, args.workers))
+    # rasterio hands integer cache sizes to GDAL as bytes.
+    return {'GDAL_NUM_THREADS': str(threads), 'GDAL_CACHEMAX': cache_mb * 2 ** 20}
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def valid_tile_mask(src, grid, np, max_size=2048, pixel_scale=1.0):
+    """Flags the tiles of `grid` that hold at least one valid pixel.
+
+    Validity comes from the dataset mask, which combines the nodata value,
+    internal mask and alpha band. It is read decimated to at most
+    `max_size` pixels a side, so GDAL serves it from overviews when they
+    exist. Each tile footprint is widened by one coarse pixel so that thin
+    slivers blurred by the decimation are still processed. `pixel_scale`
+    is the number of source pixels per grid pixel. Returns None when the
+    raster declares no nodata or mask at all.
+    """
+    from rasterio.enums import MaskFlags, Resampling
+
+    if all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+        return None
+
+    scale = max(1, math.ceil(max(src.width, src.height) / max_size))
+    out_shape = (math.ceil(src.height / scale), math.ceil(src.width / scale))
+    mask = src.dataset_mask(out_shape=out_shape, resampling=Resampling.average) > 0
+
+    # Summed-area table: valid pixel count of any coarse rectangle in O(1).
+    table = np.zeros((out_shape[0] + 1, out_shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    def bounds(count, size):
+        start = np.arange(count) * grid.step * pixel_scale
+        lo = np.clip(np.floor(start / scale).astype(np.int64) - 1, 0, size)
+        hi = np.clip(np.ceil((start + grid.tile_size * pixel_scale) / scale).astype(np.int64) + 1, 0, size)
+        return lo, hi
+
+    y0, y1 = bounds(grid.rows, out_shape[0])
+    x0, x1 = bounds(grid.cols, out_shape[1])
+    counts = (table[y1][:, x1] - table[y0][:, x1] - table[y1][:, x0] + table[y0][:, x0])
+    return counts > 0
+
+def load_aoi(path):
+    """Reads the area of interest as one shapely geometry in the raster's CRS."""
+    from shapely.geometry import shape
+    from shapely.ops import unary_union
+
+    with open(path, 'r', encoding='utf-8') as f:
+        collection = json.load(f)
+    features = collection.get('features', [collection])
+    return unary_union([shape(feature['geometry']) for feature in features if feature.get('geometry')])
+
+def aoi_tile_mask(aoi, grid, transform, np):
+    """Flags the tiles of `grid` whose footprint intersects the area of interest."""
+    from shapely.geometry import Polygon
+    from shapely.prepared import prep
+
+    prepared = prep(aoi)
+    mask = np.zeros((grid.rows, grid.cols), dtype=bool)
+    for row in range(grid.rows):
+        for col in range(grid.cols):
+            x0, y0 = col * grid.step, row * grid.step
+            x1, y1 = min(x0 + grid.tile_size, grid.width), min(y0 + grid.tile_size, grid.height)
+            footprint = Polygon([transform * corner for corner in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))])
+            mask[row, col] = prepared.intersects(footprint)
+    return mask
+
+def georeference_boxes(xyxy, x_off, y_off, transform, np):
+    """Maps pixel boxes of a tile at (x_off, y_off) to georeferenced bounds.
+
+    All four corners go through the full affine transform, so rotated or
+    sheared geotransforms yield the enclosing (minx, miny, maxx, maxy) box.
+    """
+    px = xyxy[:, [0, 2, 2, 0]] + x_off
+    py = xyxy[:, [1, 1, 3, 3]] + y_off
+    gx = transform.a * px + transform.b * py + transform.c
+    gy = transform.d * px + transform.e * py + transform.f
+    return np.stack([gx.min(axis=1), gy.min(axis=1), gx.max(axis=1), gy.max(axis=1)], axis=1)
+
+def collect_detections(batch, results, transform, conf_threshold, grid, np):
+    """Maps one batch of model results back to georeferenced boxes.
+
+    `batch` is a list of (x, y, tile) tuples; each result is mapped back to
+    the pixel offset of the tile it came from. The box, confidence and
+    class tensors are pulled once per tile and processed as arrays.
+    Returns one BOX_FIELDS array per tile.
+    """
+    per_tile = []
+    for (x, y, _), r in zip(batch, results):
+        xyxy = r.boxes.xyxy.cpu().numpy().astype(np.float64).reshape(-1, 4)
+        conf = r.boxes.conf.cpu().numpy().reshape(-1)
+        cls = r.boxes.cls.cpu().numpy().reshape(-1)
+        keep = conf >= conf_threshold
+        xyxy = xyxy[keep]
+
+        bounds = georeference_boxes(xyxy, x, y, transform, np)
+        detections = np.empty(len(bounds), dtype=np.dtype(BOX_FIELDS))
+        detections['x1'], detections['y1'], detections['x2'], detections['y2'] = bounds.T
+        detections['confidence'] = conf[keep]
+        detections['class_id'] = cls[keep]
+        detections['px'] = x + (xyxy[:, 0] + xyxy[:, 2]) / 2
+        detections['py'] = y + (xyxy[:, 1] + xyxy[:, 3]) / 2
+        detections['interior'] = grid.interior(xyxy, x, y)
+        per_tile.append(detections)
+    return per_tile
+
+class BucketedNMS:
+    """Cross-tile de-duplication restricted to the zones where tiles overlap.
+
+    Both axes are cut into alternating segments: strips covered by two
+    neighbouring tiles and tile cores covered by one. A box lying entirely
+    inside its tile's core cannot touch a box from another tile, and the
+    model already ran NMS within the tile, so interior boxes pass straight
+    through. Every other box goes into the bucket of the segment cell
+    holding its centre, and each bucket runs NMS only against its eight
+    neighbour buckets, which is far enough for boxes no wider than the
+    narrowest segment. Wider boxes, up to `max_box` pixels (by default the
+    tile size, the largest box a tile can hold), reach `radius` segments:
+    the buckets further out contribute only their wide boxes, or all their
+    boxes to a bucket holding a wide box itself. Neighbours that are already
+    final contribute their survivors only, which keeps the result equal to
+    one global NMS except where a box is suppressed by a neighbour that a
+    later bucket then suppresses in turn.
+
+    Tiles may arrive in any order. Once tile rows 0..R are all complete no
+    later tile can put a box into segment rows up to 2R + 1, so the buckets
+    `radius` rows short of that are finalized and returned.
+    """
+
+    def __init__(self, grid, nms, np, max_box=None):
+        self.grid = grid
+        self.nms = nms
+        self.np = np
+        self.narrow = min(grid.overlap, grid.step - grid.overlap)
+        self.radius = self.segment_radius(max_box or grid.tile_size)
+        self.empty = np.empty(0, dtype=np.dtype(BOX_FIELDS))
+        self.pending = collections.defaultdict(list)
+        self.kept = {}
+        self.tiles_done = collections.Counter()
+        self.complete_rows = 0
+        self.next_segment_row = 0
+
+    def add_tile(self, row, detections):
+        """Adds the detections of one tile and returns every newly finalized detection."""
+        np = self.np
+        finalized = [detections[detections['interior']]]
+
+        boundary = detections[~detections['interior']]
+        if len(boundary):
+            sy = self.grid.segment(boundary['py'], np)
+            sx = self.grid.segment(boundary['px'], np)
+            order = np.lexsort((sx, sy))
+            keys = np.stack([sy[order], sx[order]], axis=1)
+            starts = np.flatnonzero(np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+            for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+                self.pending[tuple(keys[start].tolist())].append(boundary[order[start:end]])
+
+        self.tiles_done[row] += 1
+        while self.complete_rows < self.grid.rows and self.tiles_done[self.complete_rows] == self.grid.tiles_in_row(self.complete_rows):
+            del self.tiles_done[self.complete_rows]
+            self.complete_rows += 1
+        last = 2 * self.complete_rows - 1 - self.radius if self.complete_rows < self.grid.rows else None
+        finalized.extend(self.finalize_segment_rows(last))
+        return np.concatenate(finalized)
+
+    def segment_radius(self, extent):
+        """Most segments between the centres of two overlapping boxes up to `extent` pixels wide."""
+        # Their centres are less than `extent` apart, and the segments
+        # crossed in between alternate strips and cores, narrowest first.
+        widths = sorted((self.grid.overlap, self.grid.step - self.grid.overlap))
+        radius, span = 1, widths[0]
+        while span < extent:
+            span += widths[radius % 2]
+            radius += 1
+        return radius
+
+    def finalize_segment_rows(self, last):
+        """Finalizes every pending bucket up to segment row `last` (None for all)."""
+        finalized = []
+        pending_rows = sorted({sy for sy, _ in self.pending if last is None or sy <= last})
+        for sy in pending_rows:
+            for key in sorted(key for key in self.pending if key[0] == sy):
+                finalized.append(self.finalize_bucket(key))
+            # Survivors are only needed as suppressors for the next `radius` segment rows.
+            for key in [key for key in self.kept if key[0] < sy - self.radius]:
+                del self.kept[key]
+        return finalized
+
+    def wide(self, detections):
+        """Mask of the boxes too wide for the eight neighbour buckets to hold all their overlaps."""
+        return self.np.maximum(detections['x2'] - detections['x1'], detections['y2'] - detections['y1']) > self.narrow
+
+    def neighbours(self, key, everything=False):
+        """Boxes of the buckets around `key`; beyond the adjacent ones only wide boxes unless `everything`."""
+        sy, sx = key
+        reach = range(-self.radius, self.radius + 1)
+        for dy in reach:
+            for dx in reach:
+                neighbour = (sy + dy, sx + dx)
+                if neighbour == key:
+                    continue
+                if neighbour in self.kept:
+                    boxes = [self.kept[neighbour]]
+                elif neighbour in self.pending:
+                    boxes = self.pending[neighbour]
+                else:
+                    continue
+                if everything or max(abs(dy), abs(dx)) <= 1:
+                    yield from boxes
+                else:
+                    for detections in boxes:
+                        yield detections[self.wide(detections)]
+
+    def finalize_bucket(self, key):
+        np = self.np
+        own = np.concatenate(self.pending.pop(key))
+        candidates = np.concatenate([own] + list(self.neighbours(key, self.wide(own).any())))
+        if len(candidates) > 1:
+            keep = np.zeros(len(candidates), dtype=bool)
+            keep[self.nms(candidates)] = True
+            own = own[keep[:len(own)]]
+        self.kept[key] = own
+        return own
+
+def overlap_graph(boxes, scores, np, min_iou=0.0, block_size=262144):
+    """Finds every pair of boxes overlapping by more than `min_iou`.
+
+    Boxes are binned on a grid whose cells are as large as nearly all boxes,
+    so only boxes in neighbouring cells are compared. The few boxes larger
+    than a cell are compared against every box whose cell they reach, so
+    that one huge box cannot make the cells, and the search, huge. Returns
+    `order`, the box indices by descending score, and the (sources, targets,
+    ious) edges as positions in that order, each source scoring higher than
+    its target.
+    """
+    n = len(boxes)
+    empty = np.empty(0, dtype=np.int64)
+    if n == 0:
+        return empty, empty, empty, np.empty(0, dtype=np.float32)
+    order = np.argsort(-scores, kind='stable')
+    boxes = np.asarray(boxes, dtype=np.float64)[order]
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    areas = widths * heights
+
+    cell_w = max(float(np.percentile(widths, CELL_PERCENTILE)), 1e-9)
+    cell_h = max(float(np.percentile(heights, CELL_PERCENTILE)), 1e-9)
+    oversized = np.flatnonzero((widths > cell_w) | (heights > cell_h))
+    fitting = np.flatnonzero((widths <= cell_w) & (heights <= cell_h))
+    # Columns are offset by one so that neighbour keys never wrap rows.
+    col = np.floor((boxes[:, 0] + boxes[:, 2]) / 2 / cell_w).astype(np.int64)
+    row = np.floor((boxes[:, 1] + boxes[:, 3]) / 2 / cell_h).astype(np.int64)
+    col_offset = int(col.min()) - 1
+    row_offset = int(row.min())
+    col -= col_offset
+    row -= row_offset
+    cols = int(col.max()) + 2
+    key = row * cols + col
+    by_key = fitting[np.argsort(key[fitting], kind='stable')]
+    sorted_keys = key[by_key]
+
+    sources, targets, ious = [], [], []
+
+    def add_pairs(i, j):
+        """Keeps the pairs of boxes `i` and `j` that overlap by more than `min_iou`."""
+        # Only higher scoring boxes can suppress.
+        i, j = np.maximum(i, j), np.minimum(i, j)
+        w = np.minimum(boxes[i, 2], boxes[j, 2]) - np.maximum(boxes[i, 0], boxes[j, 0])
+        h = np.minimum(boxes[i, 3], boxes[j, 3]) - np.maximum(boxes[i, 1], boxes[j, 1])
+        inter = np.clip(w, 0, None) * np.clip(h, 0, None)
+        iou = inter / (areas[i] + areas[j] - inter)
+        overlap = iou > min_iou
+        sources.append(j[overlap])
+        targets.append(i[overlap])
+        ious.append(iou[overlap].astype(np.float32))
+
+    def gather(first, counts):
+        """The boxes in the `counts` keys from each `first` position of `sorted_keys`."""
+        total = int(counts.sum())
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        return by_key[np.arange(total) - run_starts + np.repeat(first, counts)]
+
+    for start in range(0, len(by_key), block_size):
+        # Walking the boxes in key order keeps the searches cache friendly.
+        i_block = by_key[start:start + block_size]
+        for dy in (-1, 0, 1):
+            # The three neighbour cells in a row are adjacent keys.
+            row_keys = key[i_block] + dy * cols
+            first = np.searchsorted(sorted_keys, row_keys - 1, side='left')
+            counts = np.searchsorted(sorted_keys, row_keys + 1, side='right') - first
+            if counts.any():
+                i = np.repeat(i_block, counts)
+                j = gather(first, counts)
+                # Every pair is found from both ends; keep one.
+                higher = j < i
+                add_pairs(i[higher], j[higher])
+
+    for k, i in enumerate(oversized):
+        # A fitting box touching this one has its centre within half a cell of it.
+        c0, c1 = np.floor((boxes[i, [0, 2]] + [-cell_w / 2, cell_w / 2]) / cell_w).astype(np.int64) - col_offset
+        r0, r1 = np.floor((boxes[i, [1, 3]] + [-cell_h / 2, cell_h / 2]) / cell_h).astype(np.int64) - row_offset
+        rows = np.arange(max(r0, 0), max(r1 + 1, 0))
+        first = np.searchsorted(sorted_keys, rows * cols + max(c0, 0), side='left')
+        counts = np.searchsorted(sorted_keys, rows * cols + min(c1, cols - 1), side='right') - first
+        # Oversized boxes are few, so they are compared with each other directly.
+        j = np.concatenate([gather(first, counts), oversized[:k]])
+        if len(j):
+            add_pairs(np.full(len(j), i), j)
+
+    if not sources:
+        return order, empty, empty, np.empty(0, dtype=np.float32)
+    return order, np.concatenate(sources), np.concatenate(targets), np.concatenate(ious)
+
+def resolve_suppression(n, sources, targets, np, candidates=None):
+    """Resolves suppression edges between `n` score-ordered boxes like greedy NMS.
+
+    Runs a few vectorized passes: a box with no live suppressor left is
+    kept, and every box a kept box points at is suppressed. Boxes outside
+    `candidates` are never kept. Returns the boolean mask of kept boxes.
+    """
+    undecided, kept, suppressed = 0, 1, 2
+    state = np.zeros(n, dtype=np.int8)
+    if candidates is not None:
+        state[~candidates] = suppressed
+    while True:
+        live = np.bincount(targets, minlength=n)
+        newly_kept = (state == undecided) & (live == 0)
+        if not newly_kept.any():
+            break
+        state[newly_kept] = kept
+        state[targets[state[sources] == kept]] = suppressed
+        active = (state[targets] == undecided) & (state[sources] != suppressed)
+        sources, targets = sources[active], targets[active]
+    return state == kept
+
+class ResultWriter:
+    """Appends finalized detections to the binary result file as they arrive.
+
+    Each flushed chunk is announced with a `CHUNK:{"offset": ..., "count": ...}`
+    line so that the plugin can read it while the run is still going.
+    """
+
+    def __init__(self, path, out, np):
+        self.path = path
+        self.out = out
+        self.np = np
+        self.count = 0
+        self.file = open(path, 'wb')
+
+    def write(self, detections):
+        np = self.np
+        for start in range(0, len(detections), RESULT_CHUNK_SIZE):
+            chunk = detections[start:start + RESULT_CHUNK_SIZE]
+            records = np.empty(len(chunk), dtype=np.dtype(DETECTION_FIELDS))
+            records['x'] = (chunk['x1'] + chunk['x2']) / 2
+            records['y'] = (chunk['y1'] + chunk['y2']) / 2
+            records['confidence'] = chunk['confidence']
+            records['class_id'] = chunk['class_id']
+            self.file.write(records.tobytes())
+            self.file.flush()
+
+            print("CHUNK:" + json.dumps({'offset': self.count, 'count': len(chunk)}), file=self.out)
+            self.out.flush()
+            self.count += len(chunk)
+
+    def close(self):
+        self.file.close()
+
+class VectorWriter:
+    """Streams finalized detections into a GeoPackage or FlatGeobuf file with fiona.
+
+    Points sit at the box centres; with `boxes` the box bounds are kept as
+    xmin/ymin/xmax/ymax attributes too. Each write appends its features in
+    one transaction, so nothing accumulates in memory however large the
+    run. Both formats get a spatial index.
+    """
+
+    def __init__(self, path, crs_wkt, class_names, fiona, np, boxes=False):
+        self.path = path
+        self.class_names = class_names
+        self.np = np
+        self.boxes = boxes
+        self.count = 0
+        driver = OUTPUT_DRIVERS[os.path.splitext(path)[1].lower()]
+        properties = {'confidence': 'float', 'class': 'str'}
+        if boxes:
+            properties.update(xmin='float', ymin='float', xmax='float', ymax='float')
+        options = {'layer': OUTPUT_LAYER} if driver == 'GPKG' else {}
+        # A GeoPackage may hold other layers, and fiona replaces just this one;
+        # a FlatGeobuf file is a single layer that would be appended to.
+        if driver == 'FlatGeobuf' and os.path.exists(path):
+            os.remove(path)
+        self.collection = fiona.open(
+            path, 'w', driver=driver, crs_wkt=crs_wkt,
+            schema={'geometry': 'Point', 'properties': properties},
+            SPATIAL_INDEX='YES', **options
+        )
+
+    def write(self, detections):
+        xs = ((detections['x1'] + detections['x2']) / 2).tolist()
+        ys = ((detections['y1'] + detections['y2']) / 2).tolist()
+        classes = [self.class_names[class_id] for class_id in detections['class_id'].tolist()]
+        columns = [xs, ys, detections['confidence'].tolist(), classes]
+        if self.boxes:
+            columns += [detections[name].tolist() for name in ('x1', 'y1', 'x2', 'y2')]
+
+        records = []
+        for x, y, confidence, class_name, *bounds in zip(*columns):
+            properties = {'confidence': confidence, 'class': class_name}
+            if bounds:
+                properties.update(zip(('xmin', 'ymin', 'xmax', 'ymax'), bounds))
+            records.append({'geometry': {'type': 'Point', 'coordinates': (x, y)}, 'properties': properties})
+        self.collection.writerecords(records)
+        self.count += len(records)
+
+    def close(self):
+        self.collection.close()
+
+def checkpoint_path(args, grid, scale=1.0):
+    """Locates the checkpoint of a run, keyed by raster, model and tiling parameters."""
+    key = {
+        'tile_size': grid.tile_size,
+        'overlap': grid.overlap,
+        'scale': scale,
+        'fields': BOX_FIELDS,
+        'thresholds': model_thresholds(args),
+        'bands': args.bands,
+        'backend': [args.backend, args.int8],
+        'per_tile_scaling': args.per_tile_scaling,
+    }
+    for name in ('input', 'model'):
+        path = os.path.abspath(getattr(args, name))
+        stat = os.stat(path)
+        key[name] = [path, stat.st_size, stat.st_mtime]
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(checkpoint_dir(args), digest[:32] + '.sqlite')
+
+def checkpoint_dir(args):
+    return args.checkpoint_dir or os.path.join(os.path.expanduser("~"), ".tree_detector_plugin", "checkpoints")
+
+def prune_checkpoints(directory, max_age=CHECKPOINT_MAX_AGE):
+    """Deletes the checkpoints in `directory` not written to for `max_age` seconds.
+
+    A job whose raster, model, bands or tiling changed gets a new key, so
+    the checkpoints of abandoned runs would otherwise pile up forever.
+    """
+    cutoff = time.time() - max_age
+    for path in glob.glob(os.path.join(glob.escape(directory), '*.sqlite*')):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Gone already, or still open in another run.
+            pass
+
+class CheckpointStore:
+    """SQLite store of the raw per-tile detections of one run.
+
+    Every batch of tiles is committed as soon as it is post-processed, so
+    a run that is killed part-way loses at most the batches in flight.
+    Detections are stored before de-duplication so that a resumed run can
+    replay them through BucketedNMS exactly as if they had just been
+    inferred.
+    """
+
+    def __init__(self, path, np):
+        self.path = path
+        self.np = np
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Tiles are saved from the post-processing thread.
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS tiles (x INTEGER, y INTEGER, detections BLOB, PRIMARY KEY (x, y))")
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute("DELETE FROM tiles")
+        self.db.commit()
+
+    def load(self):
+        """Returns the detections of every completed tile, keyed by (x, y)."""
+        dtype = self.np.dtype(BOX_FIELDS)
+        return {
+            (x, y): self.np.frombuffer(blob, dtype=dtype).copy()
+            for x, y, blob in self.db.execute("SELECT x, y, detections FROM tiles")
+        }
+
+    def save(self, tiles):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO tiles (x, y, detections) VALUES (?, ?, ?)",
+            [(x, y, detections.tobytes()) for x, y, detections in tiles]
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def discard(self):
+        os.remove(self.path)
+
+def put_or_stop(out_queue, item, stop):
+    """Blocks until `item` fits in the bounded queue or the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def drain(in_queue, stop):
+    """Yields items from `in_queue` until the end marker or a pipeline stop."""
+    while True:
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return
+            continue
+        if item is _END:
+            return
+        yield item
+
+def feed(produce, out_queue, stop):
+    """Pushes every item of `produce` into `out_queue`, followed by the end marker."""
     try:
+        for item in produce:
+            if not put_or_stop(out_queue, item, stop):
+                return
+    finally:
+        put_or_stop(out_queue, _END, stop)
+
+def start_stage(name, work, stop, errors):
+    """Runs `work` in a background pipeline thread.
+
+    An exception in the stage is recorded in `errors` and stops the whole
+    pipeline so that no other stage blocks forever on a full or empty queue.
+    """
+    def run():
+        try:
+            work()
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children in MB, or None where unsupported."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10), 1)
+
+class Telemetry:
+    """Cumulative per-stage timings of a run, reported as TELEMETRY lines.
+
+    Stages run on different threads or worker processes, so their times
+    overlap and can add up to more than the elapsed time. Throughput and
+    ETA count only the tiles run in this session, not tiles restored from
+    a checkpoint. With `profile`, every thread run through `profiled` is
+    also recorded with cProfile.
+    """
+
+    STAGES = ('read', 'preprocess', 'inference', 'postprocess', 'nms')
+
+    def __init__(self, out, total_tiles=0, interval=5.0, profile=False):
+        self.out = out
+        self.total_tiles = total_tiles
+        self.interval = interval
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.tiles = 0
+        self.started = time.perf_counter()
+        self.reported = self.started
+        self.lock = threading.Lock()
+        self.profiles = [] if profile else None
+        self.profiling = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add({name: time.perf_counter() - start})
+
+    def add(self, seconds):
+        with self.lock:
+            for name, value in seconds.items():
+                self.seconds[name] += value
+
+    def tiles_done(self, count):
+        """Counts finished tiles, reporting at most once per `interval` seconds."""
+        self.tiles += count
+        if time.perf_counter() - self.reported >= self.interval:
+            self.report()
+
+    def report(self, final=False):
+        now = time.perf_counter()
+        self.reported = now
+        elapsed = now - self.started
+        rate = self.tiles / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, self.total_tiles - self.tiles)
+        with self.lock:
+            stages = {name: round(value, 3) for name, value in self.seconds.items()}
+        telemetry = {
+            'elapsed': round(elapsed, 3),
+            'tiles': self.tiles,
+            'total': self.total_tiles,
+            'tiles_per_second': round(rate, 2),
+            'eta': round(remaining / rate, 1) if rate else None,
+            'stages': stages,
+            'peak_rss_mb': peak_rss_mb(),
+            'final': final,
+        }
+        print("TELEMETRY:" + json.dumps(telemetry), file=self.out)
+        self.out.flush()
+
+    def profiled(self, work):
+        """Wraps `work` so that it runs under its own profiler when profiling.
+
+        From Python 3.12 one profiler sees every thread and no second one
+        can start, so work started while it runs is not wrapped again.
+        """
+        if self.profiles is None:
+            return work
+
+        def run(*args, **kwargs):
+            import cProfile
+            with self.lock:
+                if sys.version_info >= (3, 12) and self.profiling:
+                    profile = None
+                else:
+                    profile = cProfile.Profile()
+                    self.profiling += 1
+            if profile is None:
+                return work(*args, **kwargs)
+            profile.enable()
+            try:
+                return work(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.lock:
+                    self.profiling -= 1
+                    self.profiles.append(profile)
+        return run
+
+    def dump_profile(self, path):
+        """Merges the profiles of every thread into one pstats file."""
+        import pstats
+        if self.profiles:
+            pstats.Stats(*self.profiles).dump_stats(path)
+
+class ModelCache:
+    """Keeps recently used YOLO models loaded, evicting the least recently used.
+
+    Models are keyed by path and modification time so that a retrained
+    model written over the same file is picked up on the next job.
+    """
+
+    def __init__(self, loader, max_models=2):
+        self.loader = loader
+        self.max_models = max(1, max_models)
+        self.models = collections.OrderedDict()
+
+    def get(self, model_path, *options):
+        """Returns the model at `model_path` loaded with `options` (e.g. backend and INT8)."""
+        path = os.path.abspath(model_path)
+        key = (path, os.path.getmtime(path)) + options
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        model = self.loader(path, *options)
+        self.models[key] = model
+        while len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return model
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def export_model(model_path, backend, int8=False, imgsz=TILE_SIZE):
+    """Exports a .pt model for `backend` ('onnx' or 'openvino') once and returns the cached artifact.
+
+    Exports live under ~/.tree_detector_plugin/exports, keyed by the hash
+    of the weights, the input size, the backend, INT8 and the ultralytics
+    version. They are exported with dynamic axes so that batches and edge
+    tiles work. With `int8`, ONNX weights get dynamic INT8 quantization
+    from ONNX Runtime.
+    """
+    import ultralytics
+    from ultralytics import YOLO
+
+    name = f"{file_digest(model_path)[:16]}-{imgsz}-{backend}{'-int8' if int8 else ''}-{ultralytics.__version__}"
+    directory = os.path.join(os.path.expanduser("~"), ".tree_detector_plugin", "exports", name)
+    artifact = os.path.join(directory, 'model.onnx' if backend == 'onnx' else 'model_openvino_model')
+    if os.path.exists(artifact):
+        return artifact
+
+    # Exported next to a copy of the weights, then published in one rename
+    # so that concurrent runs never see a half-written export.
+    staging = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        weights = os.path.join(staging, 'model.pt')
+        shutil.copyfile(model_path, weights)
+        exported = YOLO(weights).export(format=backend, imgsz=imgsz, dynamic=True)
+        if int8:
+            quantize_onnx(exported)
+        os.remove(weights)
+        try:
+            os.replace(staging, directory)
+        except OSError:
+            if not os.path.exists(artifact):
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return artifact
+
+def quantize_onnx(path):
+    """Applies dynamic INT8 weight quantization to an ONNX model in place, keeping its metadata."""
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantized = path + '.int8'
+    quantize_dynamic(path, quantized, weight_type=QuantType.QUInt8)
+    # ultralytics reads class names and input size from the metadata.
+    model = onnx.load(quantized)
+    del model.metadata_props[:]
+    model.metadata_props.extend(onnx.load(path).metadata_props)
+    onnx.save(model, quantized)
+    os.replace(quantized, path)
+
+def load_model(model_path, backend='torch', int8=False):
+    """Loads a YOLO model for inference with PyTorch, ONNX Runtime or OpenVINO.
+
+    Exported backends match the PyTorch model within about 1 px of box
+    position and 0.01 of confidence; with INT8 expect up to a few pixels
+    and 0.05, with a handful of boxes near the confidence threshold
+    appearing or disappearing.
+    """
+    from ultralytics import YOLO
+
+    if backend == 'torch':
+        return YOLO(model_path)
+    return YOLO(export_model(model_path, backend, int8), task='detect')
+
+def model_thresholds(args):
+    """Returns the (conf, iou, max_det) the model runs with.
+
+    With --raw-file the model keeps everything above the floor confidence
+    and only merges near-identical boxes; the user's thresholds are then
+    applied in post-processing. The near-duplicates it keeps need room
+    beyond the usual per-tile box limit, or they would crowd out real
+    crowns in dense tiles.
+    """
+    if args.raw_file:
+        return min(args.raw_conf, args.conf), max(args.raw_iou, args.iou), max(args.raw_max_det, args.max_det)
+    return args.conf, args.iou, args.max_det
+
+def infer(model, batch, args):
+    """Runs one batch of (x, y, tile) tuples through the model."""
+    # Class-agnostic in-tile NMS at the user's IoU lets BucketedNMS pass
+    # interior boxes through untouched.
+    conf, iou, max_det = model_thresholds(args)
+    return model([tile for _, _, tile in batch], verbose=False, conf=conf, iou=iou, max_det=max_det, agnostic_nms=True)
+
+def run_pipeline(args, src, model, grid, offsets, reader, handle_tiles, np, rasterio, telemetry):
+    """Runs detection over the tile `offsets` in this process as a threaded pipeline.
+
+    reader -> preprocess -> inference (calling thread) -> postprocess, with
+    bounded queues in between so that at most a few batches are in flight.
+    Stage times are added to `telemetry`.
+    """
+    batch_size = max(1, args.batch_size)
+    queue_depth = args.queue_depth or 2 * batch_size
+    stop = threading.Event()
+    errors = []
+    raw_queue = queue.Queue(maxsize=queue_depth)
+    tile_queue = queue.Queue(maxsize=queue_depth)
+    result_queue = queue.Queue(maxsize=2)
+    # Enough buffers for both queues, the batch being assembled and one
+    # tile in the hands of each stage.
+    buffers = BufferPool(2 * queue_depth + batch_size + 3, lambda: reader.new_buffer(np))
+    transform = reader.transform(src)
+
+    def read_tiles():
+        for x, y in offsets:
+            buffer = buffers.acquire(stop)
+            if buffer is None:
+                return
+            with telemetry.stage('read'):
+                tile = reader.read(src, x, y, buffer, rasterio)
+            yield x, y, tile
+
+    def preprocess_tiles():
+        for x, y, tile in drain(raw_queue, stop):
+            with telemetry.stage('preprocess'):
+                image = reader.prepare(tile, np)
+            if image is not tile:
+                buffers.release(tile)
+            yield x, y, image
+
+    def postprocess_batches():
+        for batch, results in drain(result_queue, stop):
+            with telemetry.stage('postprocess'):
+                per_tile = collect_detections(batch, results, transform, model_thresholds(args)[0], grid, np)
+            handle_tiles([(x, y, detections) for (x, y, _), detections in zip(batch, per_tile)])
+
+    stages = [
+        start_stage('reader', telemetry.profiled(lambda: feed(read_tiles(), raw_queue, stop)), stop, errors),
+        start_stage('preprocess', telemetry.profiled(lambda: feed(preprocess_tiles(), tile_queue, stop)), stop, errors),
+        start_stage('postprocess', telemetry.profiled(postprocess_batches), stop, errors),
+    ]
+    try:
+        for batch in iter_batches(drain(tile_queue, stop), batch_size):
+            with telemetry.stage('inference'):
+                results = infer(model, batch, args)
+            for _, _, image in batch:
+                buffers.release(image)
+            if not put_or_stop(result_queue, (batch, results), stop):
+                break
+        put_or_stop(result_queue, _END, stop)
+        stages[-1].join()
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+
+    if errors:
+        raise errors[0]
+
+# State of a --workers process, set up once by init_shard.
+_shard = {}
+
+def init_shard(args, threads, loader=load_model):
+    """Pool initializer: gives each worker process its own model, loaded with `loader`.
+
+    Torch and OpenCV are pinned to `threads` threads so that N workers do
+    not oversubscribe the machine. Rasters are opened as batches for them
+    arrive, so one pool serves every input file.
+
+    A failing initializer only makes the pool start another worker that
+    fails the same way, forever, so errors are kept and raised by the
+    worker's first task instead.
+    """
+    try:
+        os.environ['OMP_NUM_THREADS'] = str(threads)
         import numpy as np
         import cv2
         import rasterio
-        from ultralytics import YOLO
+        import torch
+
+        torch.set_num_threads(threads)
+        cv2.setNumThreads(threads)
+        # Stays active for the life of the worker process.
+        env = rasterio.Env(**gdal_options(args, rasterio, np))
+        env.__enter__()
+        _shard.update(
+            args=args, np=np, rasterio=rasterio, env=env,
+            model=loader(args.model, args.backend, args.int8),
+            path=None, src=None, buffer_key=None, buffers=None
+        )
+    except Exception as e:
+        _shard['error'] = e
+
+def shard_model():
+    """The worker's model; raises the error that kept `init_shard` from loading it."""
+    if 'error' in _shard:
+        raise _shard['error']
+    return _shard['model']
+
+def run_shard(task):
+    """Reads, preprocesses and runs inference on one (path, grid, reader, offsets) batch.
+
+    Returns the (x, y, detections) triple of every tile and the seconds
+    spent per stage, for the parent process.
+    """
+    path, grid, reader, offsets = task
+    model = shard_model()
+    args, np = _shard['args'], _shard['np']
+    if _shard['path'] != path:
+        if _shard['src'] is not None:
+            _shard['src'].close()
+        _shard.update(path=path, src=_shard['rasterio'].open(path))
+    buffer_key = (reader.tile_size, len(reader.indexes), str(reader.dtype))
+    if _shard['buffer_key'] != buffer_key:
+        _shard.update(buffer_key=buffer_key, buffers=[reader.new_buffer(np) for _ in range(max(1, args.batch_size))])
+    src = _shard['src']
+    seconds = dict.fromkeys(('read', 'preprocess', 'inference', 'postprocess'), 0.0)
+    batch = []
+    # Batches run one at a time, so the buffers are free again for the next.
+    for (x, y), buffer in zip(offsets, _shard['buffers']):
+        start = time.perf_counter()
+        tile = reader.read(src, x, y, buffer, _shard['rasterio'])
+        read = time.perf_counter()
+        batch.append((x, y, reader.prepare(tile, np)))
+        seconds['read'] += read - start
+        seconds['preprocess'] += time.perf_counter() - read
+
+    start = time.perf_counter()
+    results = infer(model, batch, args)
+    inferred = time.perf_counter()
+    per_tile = collect_detections(batch, results, reader.transform(src), model_thresholds(args)[0], grid, np)
+    seconds['inference'] += inferred - start
+    seconds['postprocess'] += time.perf_counter() - inferred
+    return [(x, y, detections) for (x, y, _), detections in zip(batch, per_tile)], seconds
+
+def shard_class_names():
+    """Class names of the worker's model, for a parent that does not load one itself."""
+    return shard_model().names
+
+def start_shard_pool(args, loader=load_model):
+    """Starts `args.workers` worker processes, each loading the model once with `loader`."""
+    import multiprocessing
+
+    threads = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.workers)
+    context = multiprocessing.get_context('spawn')
+    return context.Pool(args.workers, initializer=init_shard, initargs=(args, threads, loader))
+
+def run_sharded(pool, args, grid, offsets, reader, handle_tiles, telemetry):
+    """Spreads the tile `offsets` of raster `args.input` over the worker `pool`.
+
+    Batches are handed out one at a time as workers become free, so cheap
+    empty tiles never leave a worker idle while others still have work.
+    """
+    batches = ((args.input, grid, reader, tiles) for tiles in iter_batches(offsets, max(1, args.batch_size)))
+    for tiles, seconds in pool.imap_unordered(run_shard, batches):
+        telemetry.add(seconds)
+        handle_tiles(tiles)
+
+def expand_inputs(inputs):
+    """Expands --input values into raster paths: files and VRTs as given, glob patterns and directories sorted."""
+    paths = []
+    for value in inputs:
+        if os.path.isdir(value):
+            matches = sorted(os.path.join(value, name) for name in os.listdir(value)
+                             if os.path.splitext(name)[1].lower() in RASTER_EXTENSIONS)
+        elif any(char in value for char in '*?['):
+            matches = sorted(glob.glob(value))
+        else:
+            matches = [value]
+        if not matches:
+            raise ValueError(f"No rasters found for --input {value}")
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+def common_crs(paths, rasterio):
+    """Returns the CRS shared by every raster in `paths`; merged output needs a single one."""
+    crs = None
+    for index, path in enumerate(paths):
+        with rasterio.open(path) as src:
+            if index == 0:
+                crs = src.crs
+            elif src.crs != crs:
+                raise ValueError(f"{path} is in {src.crs}, not {crs} like {paths[0]}; reproject the inputs or build a VRT")
+    return crs
+
+def estimate_tiles(path, target_gsd, rasterio):
+    """Tiles in the full grid of the raster at `path`, before empty or out-of-AOI tiles are skipped."""
+    with rasterio.open(path) as src:
+        reader = TileReader(TILE_SIZE, None, None, scale=resample_scale(src, target_gsd))
+        return len(TileGrid(*reader.size(src), TILE_SIZE, OVERLAP))
+
+def main(args, out=None, model_cache=None):
+    out = out or sys.stdout
+    try:
+        import numpy as np
+        import rasterio
+        # Only checked here, so that a missing dependency fails before any work.
+        import ultralytics  # noqa: F401
         import torch
         import torchvision.ops as ops
-        from shapely.geometry import box, mapping
+        import shapely
     except ImportError as e:
         print(f"Error importing libraries: {e}", file=sys.stderr)
         sys.exit(1)
 
-    model = YOLO(args.model)
-    all_detections = []
-    tile_size = 640
-    overlap = 100
-
-    with rasterio.open(args.input) as src:
-        height, width = src.height, src.width
-        transform = src.transform
-
-        num_tiles_y = len(range(0, height, tile_size - overlap))
-        num_tiles_x = len(range(0, width, tile_size - overlap))
-        total_tiles = num_tiles_y * num_tiles_x if num_tiles_y > 0 else 1
-        processed_tiles = 0
-
-        for y in range(0, height, tile_size - overlap):
-            for x in range(0, width, tile_size - overlap):
-                window = rasterio.windows.Window(x, y, tile_size, tile_size)
-                tile_np = src.read(window=window)
-                
-                processed_tile = process_for_yolo(tile_np, cv2, np)
-                results = model(processed_tile, verbose=False, conf=args.conf)
-                
-                for r in results:
-                    for det_box in r.boxes:
-                        x1, y1, x2, y2 = det_box.xyxy[0].cpu().numpy()
-                        abs_x1, abs_y1 = x + x1, y + y1
-                        abs_x2, abs_y2 = x + x2, y + y2
-                        geo_x1, geo_y1 = transform * (abs_x1, abs_y1)
-                        geo_x2, geo_y2 = transform * (abs_x2, abs_y2)
-
-                        all_detections.append({
-                            'geometry': box(geo_x1, min(geo_y1, geo_y2), geo_x2, max(geo_y1, geo_y2)),
-                            'confidence': float(det_box.conf[0]),
-                            'class': model.names[int(det_box.cls[0])]
-                        })
-                
-                processed_tiles += 1
-                progress = int((processed_tiles / total_tiles) * 80)
-                print(f"PROGRESS:{progress}")
-                sys.stdout.flush()
-
-    if not all_detections:
-        final_detections = []
+    final_detections = []
+
+    paths = expand_inputs(args.input)
+    # One set of arguments per raster, so that per-raster helpers see a single input.
+    file_args = [argparse.Namespace(**dict(vars(args), input=path)) for path in paths]
+    crs = common_crs(paths, rasterio)
+    aoi = load_aoi(args.aoi) if args.aoi else None
+    if args.checkpoint or args.resume:
+        prune_checkpoints(checkpoint_dir(args))
+    target_gsd = args.target_gsd if args.target_gsd is not None else model_gsd(args.model)
+
+    def nms(detections):
+        boxes = torch.as_tensor(np.stack([detections['x1'], detections['y1'], detections['x2'], detections['y2']], axis=1), dtype=torch.float)
+        scores = torch.as_tensor(detections['confidence'], dtype=torch.float)
+        return np.asarray(ops.nms(boxes, scores, args.iou), dtype=np.int64)
+
+    def in_aoi(detections):
+        cx = (detections['x1'] + detections['x2']) / 2
+        cy = (detections['y1'] + detections['y2']) / 2
+        return shapely.contains_xy(aoi, cx, cy)
+
+    # Rasters count with their full grid until they are planned, so that the
+    # total and ETA cover the whole job from the first file on.
+    estimates = [estimate_tiles(path, target_gsd, rasterio) for path in paths]
+    telemetry = Telemetry(out, sum(estimates), profile=bool(args.profile))
+
+    def run_raster(index, args, pool):
+        """Detects trees in the raster `args.input`, the `index`-th input file."""
+        with rasterio.Env(**gdal_options(args, rasterio, np)), rasterio.open(args.input) as src:
+            indexes = band_indexes(src, args.bands)
+            dtype = src.dtypes[indexes[0] - 1]
+            convert = None
+            if dtype != 'uint8' and not args.per_tile_scaling:
+                convert = Uint8Converter.from_dataset(src, indexes, np)
+            scale = resample_scale(src, target_gsd)
+            reader = TileReader(TILE_SIZE, indexes, dtype, convert, scale)
+            if scale != 1:
+                print("RESAMPLED:" + json.dumps({'scale': scale, 'gsd': target_gsd}), file=out)
+                out.flush()
+
+            # Block alignment only means something at native resolution.
+            block_align = args.block_align and scale == 1
+            overlap = aligned_overlap(src.block_shapes[0], TILE_SIZE, OVERLAP) if block_align else OVERLAP
+            grid = TileGrid(*reader.size(src), TILE_SIZE, overlap)
+            if not args.no_skip_empty:
+                grid.valid = valid_tile_mask(src, grid, np, pixel_scale=scale)
+            outside_aoi = 0
+            if aoi is not None:
+                tiles_in_aoi = aoi_tile_mask(aoi, grid, reader.transform(src), np)
+                outside_aoi = int((~tiles_in_aoi).sum())
+                grid.valid = tiles_in_aoi if grid.valid is None else grid.valid & tiles_in_aoi
+            total_tiles = len(grid) or 1
+            if grid.valid is not None:
+                skipped = grid.rows * grid.cols - len(grid)
+                print("SKIPPED:" + json.dumps({
+                    'tiles': skipped, 'outside_aoi': outside_aoi, 'empty': skipped - outside_aoi, 'total': grid.rows * grid.cols
+                }), file=out)
+                out.flush()
+
+            deduplicator = BucketedNMS(grid, nms, np)
+
+            checkpoint = None
+            if args.checkpoint or args.resume:
+                checkpoint = CheckpointStore(checkpoint_path(args, grid, scale), np)
+                if not args.resume:
+                    checkpoint.clear()
+            completed = checkpoint.load() if args.resume else {}
+
+            processed_tiles = 0
+
+            def handle_tiles(tiles, replayed=False):
+                """Checkpoints, de-duplicates and emits the (x, y, detections) triples of finished tiles."""
+                nonlocal processed_tiles
+                if checkpoint and not replayed:
+                    checkpoint.save(tiles)
+                for x, y, detections in tiles:
+                    if raw_file:
+                        raw = detections if aoi is None else detections[in_aoi(detections)]
+                        raw_file.write(raw[[name for name, _ in RAW_FIELDS]].astype(RAW_FIELDS).tobytes())
+                        # Redo what the model would have done at the user's thresholds.
+                        detections = detections[detections['confidence'] >= args.conf]
+                        if len(detections) > 1:
+                            detections = detections[np.sort(nms(detections))]
+                    with telemetry.stage('nms'):
+                        finalized = deduplicator.add_tile(grid.row_of(y), detections)
+                    if aoi is not None and len(finalized):
+                        # Filtered after NMS so that boxes outside the AOI still
+                        # suppress their duplicates inside it.
+                        finalized = finalized[in_aoi(finalized)]
+                    if len(finalized):
+                        emit(finalized)
+
+                processed_tiles += len(tiles)
+                progress = int((index + processed_tiles / total_tiles) / len(paths) * 80)
+                print(f"PROGRESS:{progress}", file=out)
+                out.flush()
+                if not replayed:
+                    telemetry.tiles_done(len(tiles))
+
+            try:
+                offsets = []
+                replay = []
+                for x, y in grid.offsets():
+                    if (x, y) in completed:
+                        replay.append((x, y, completed.pop((x, y))))
+                    else:
+                        offsets.append((x, y))
+                if replay:
+                    print("RESUMED:" + json.dumps({'tiles': len(replay), 'total': len(grid)}), file=out)
+                    out.flush()
+                    for tiles in iter_batches(replay, RESUME_BATCH_SIZE):
+                        handle_tiles(tiles, replayed=True)
+
+                telemetry.total_tiles += len(offsets) - estimates[index]
+                if pool:
+                    run_sharded(pool, args, grid, offsets, reader, handle_tiles, telemetry)
+                else:
+                    run_pipeline(args, src, model, grid, offsets, reader, handle_tiles, np, rasterio, telemetry)
+            finally:
+                if checkpoint:
+                    checkpoint.close()
+            # A finished raster has nothing left to resume.
+            if checkpoint:
+                checkpoint.discard()
+
+    def run_rasters():
+        for index, raster_args in enumerate(file_args):
+            print("FILE:" + json.dumps({'index': index, 'count': len(paths), 'path': raster_args.input}), file=out)
+            out.flush()
+            run_raster(index, raster_args, pool)
+
+    if args.workers > 1:
+        # Every shard worker loads its own model. The parent only exports it
+        # first, so that the workers find the export cached.
+        if args.backend != 'torch':
+            export_model(args.model, args.backend, args.int8)
+        model = None
+        pool = start_shard_pool(file_args[0])
     else:
-        boxes = torch.tensor([list(d['geometry'].bounds) for d in all_detections], dtype=torch.float)
-        scores = torch.tensor([d['confidence'] for d in all_detections], dtype=torch.float)
-        keep_indices = ops.nms(boxes, scores, args.iou)
-        final_detections = [all_detections[i] for i in keep_indices]
-    
+        pool = None
+        if model_cache:
+            model = model_cache.get(args.model, args.backend, args.int8)
+        else:
+            model = load_model(args.model, args.backend, args.int8)
+
+    sinks = []
+    writer = None
+    vector_writer = None
+    raw_file = None
+    try:
+        names = pool.apply(shard_class_names) if pool else model.names
+        classes = {int(k): v for k, v in names.items()}
+        if args.result_file:
+            writer = ResultWriter(args.result_file, out, np)
+            sinks.append(writer.write)
+            print("RESULT_FILE:" + json.dumps({'path': args.result_file, 'dtype': DETECTION_FIELDS, 'classes': classes}), file=out)
+            out.flush()
+        if args.output:
+            try:
+                import fiona
+            except ImportError as e:
+                raise RuntimeError(f"--output needs the fiona package: {e}") from e
+            crs_wkt = crs.to_wkt() if crs else None
+            vector_writer = VectorWriter(args.output, crs_wkt, classes, fiona, np, args.output_boxes)
+            sinks.append(vector_writer.write)
+        if not sinks:
+            sinks.append(final_detections.append)
+
+        def emit(detections):
+            for sink in sinks:
+                sink(detections)
+
+        raw_file = open(args.raw_file, 'wb') if args.raw_file else None
+        telemetry.profiled(run_rasters)()
+        telemetry.report(final=True)
+    finally:
+        if pool:
+            pool.terminate()
+        if args.profile:
+            telemetry.dump_profile(args.profile)
+        if writer:
+            writer.close()
+        if vector_writer:
+            vector_writer.close()
+        if raw_file:
+            raw_file.close()
+
+    if writer or vector_writer:
+        result = {'count': (writer or vector_writer).count, 'classes': classes}
+        if writer:
+            result.update(path=args.result_file, dtype=DETECTION_FIELDS)
+        if vector_writer:
+            result.update(output=args.output, layer=OUTPUT_LAYER if args.output.lower().endswith('.gpkg') else None)
+        print("RESULT:" + json.dumps(result), file=out)
+        out.flush()
+        return
+
     features = []
-    for det in final_detections:
-        center_point = det['geometry'].centroid
-        features.append({
-            'type': 'Feature',
-            'geometry': mapping(center_point),
-            'properties': {
-                'confidence': det['confidence'],
-                'class': det['class']
-            }
-        })
+    for chunk in final_detections:
+        xs = ((chunk['x1'] + chunk['x2']) / 2).tolist()
+        ys = ((chunk['y1'] + chunk['y2']) / 2).tolist()
+        for x, y, confidence, class_id in zip(xs, ys, chunk['confidence'].tolist(), chunk['class_id'].tolist()):
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [x, y]},
+                'properties': {
+                    'confidence': confidence,
+                    'class': classes[class_id]
+                }
+            })
 
-    print(json.dumps(features))
+    print(json.dumps(features), file=out)
+    out.flush()
 
+def worker_state_path():
+    return os.path.join(os.path.expanduser("~"), ".tree_detector_plugin", "worker.json")
 
-if __name__ == '__main__':
+def read_job(conn, token, timeout=10.0):
+    """Reads the JSON request line of a worker connection; None if its token is wrong."""
+    conn.settimeout(timeout)
+    with conn.makefile('r', encoding='utf-8') as reader:
+        job = json.loads(reader.readline())
+    conn.settimeout(None)
+    if not secrets.compare_digest(str(job.get('token', '')), token):
+        return None
+    return job
+
+def handle_job(conn, job, model_cache):
+    """Runs `job` and answers on its worker connection, which it closes when done."""
+    try:
+        with conn, conn.makefile('w', encoding='utf-8') as writer:
+            print("ACCEPTED", file=writer)
+            writer.flush()
+            try:
+                args = parse_args(job.get('argv'))
+            except SystemExit:
+                print("ERROR:Invalid arguments, see the worker log for details", file=writer)
+                return
+
+            try:
+                main(args, out=writer, model_cache=model_cache)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                print(f"ERROR:{e}".replace("\n", " "), file=writer)
+                return
+            print("DONE", file=writer)
+    except ConnectionError as e:
+        # The client went away, which is how it cancels.
+        print(f"Job aborted: {e}", file=sys.stderr)
+
+def serve(args):
+    """Runs a long-lived detection worker that keeps models loaded between jobs.
+
+    The worker listens on a localhost port and writes its address and an
+    access token to `worker_state_path()`. Each connection sends one JSON
+    line `{"token": ..., "argv": [...]}` with the same arguments as the
+    command line. The worker answers `ACCEPTED` straight away, then the
+    usual stdout protocol (PROGRESS lines and the result) followed by
+    `DONE` or `ERROR:<message>`. Jobs run one at a time on their own
+    thread; a request arriving while one runs is answered `BUSY`, so that
+    the client can run the script itself rather than wait. Closing the
+    connection cancels the job. The worker exits after `--idle-timeout`
+    seconds without a job.
+    """
+    try:
+        import ultralytics
+    except ImportError as e:
+        print(f"Error importing libraries: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    model_cache = ModelCache(load_model, args.max_models)
+    token = secrets.token_hex(16)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(4)
+    server.settimeout(args.idle_timeout)
+
+    state_path = worker_state_path()
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    script_path = os.path.abspath(__file__)
+    state = {
+        'pid': os.getpid(),
+        'port': server.getsockname()[1],
+        'token': token,
+        'python': sys.executable,
+        'script': script_path,
+        'script_mtime': os.path.getmtime(script_path),
+    }
+    fd = os.open(state_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f)
+
+    running = None
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if running and running.is_alive():
+                    continue
+                break
+            try:
+                job = read_job(conn, token)
+            except (OSError, ValueError) as e:
+                # The client went away or sent garbage; wait for the next job.
+                print(f"Request ignored: {e}", file=sys.stderr)
+                conn.close()
+                continue
+            if job is None:
+                conn.close()
+            elif job.get('command') == 'shutdown':
+                # A running job still finishes before the process exits.
+                conn.close()
+                break
+            elif running and running.is_alive():
+                with conn:
+                    try:
+                        conn.sendall(b"BUSY\n")
+                    except OSError:
+                        pass
+            else:
+                running = threading.Thread(target=handle_job, args=(conn, job, model_cache))
+                running.start()
+    finally:
+        server.close()
+        try:
+            with open(state_path) as f:
+                if json.load(f).get('pid') == os.getpid():
+                    os.remove(state_path)
+        except (OSError, ValueError):
+            pass
+
+def band_list(value):
+    try:
+        bands = [int(band) for band in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid band list: {value!r}")
+    if not 1 <= len(bands) <= 3:
+        raise argparse.ArgumentTypeError("expected one to three band numbers")
+    return bands
+
+def build_parser():
     parser = argparse.ArgumentParser(description='YOLO Detection Script for QGIS Plugin')
-    parser.add_argument('--input', required=True, help='Path to input raster file')
-    parser.add_argument('--model', required=True, help='Path to YOLO model file')
-    parser.add_argument('--conf', type=float, required=True, help='Confidence threshold')
-    parser.add_argument('--iou', type=float, required=True, help='IoU threshold for NMS')
-    
-    args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    parser.add_argument('--input', nargs='+', help='Input rasters: files, VRTs, glob patterns or directories; all are processed with one model load into one merged result')
+    parser.add_argument('--model', help='Path to YOLO model file')
+    parser.add_argument('--conf', type=float, help='Confidence threshold')
+    parser.add_argument('--iou', type=float, help='IoU threshold for NMS')
+    parser.add_argument('--backend', choices=('torch', 'onnx', 'openvino'), default='torch', help='Inference runtime; onnx and openvino export the model once and cache it')
+    parser.add_argument('--int8', action='store_true', help='Apply dynamic INT8 quantization to the exported model (onnx backend only)')
+    parser.add_argument('--target-gsd', type=float, help='Ground sample distance in metres the model was trained at; finer rasters are read decimated to it (default: "gsd" from a <model>.json sidecar; 0 keeps the native resolution)')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of tiles sent to the model per inference call')
+    parser.add_argument('--queue-depth', type=int, default=0, help='Tiles buffered ahead of inference per stage (default: twice the batch size)')
+    parser.add_argument('--bands', type=band_list, help='Comma-separated red, green and blue band numbers, e.g. 4,3,2 (default: the first three bands)')
+    parser.add_argument('--per-tile-scaling', action='store_true', help='Scale non-uint8 tiles by their own maximum instead of raster-wide percentile statistics')
+    parser.add_argument('--aoi', help='GeoJSON file with polygons in the raster CRS; only tiles intersecting them are processed and detections outside them are dropped')
+    parser.add_argument('--no-skip-empty', action='store_true', help='Process every tile, even those holding only nodata or masked pixels')
+    parser.add_argument('--block-align', action='store_true', help='Widen the tile overlap so that tiles start on raster block boundaries (helps when the GDAL cache is small)')
+    parser.add_argument('--gdal-threads', type=int, default=0, help='Threads GDAL uses to decode compressed blocks (default: CPU count / workers)')
+    parser.add_argument('--gdal-cache', type=int, default=0, help='GDAL block cache size in MB per process (default: enough for two strips of tiles, shared between workers)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes the tile grid is sharded across, each with its own model')
+    parser.add_argument('--threads-per-worker', type=int, default=0, help='Torch/OpenCV threads per worker process (default: CPU count / workers)')
+    parser.add_argument('--checkpoint', action='store_true', help='Save raw per-tile detections so that an interrupted run can be resumed')
+    parser.add_argument('--resume', action='store_true', help='Reuse the tiles completed by an earlier interrupted run of the same job (implies --checkpoint)')
+    parser.add_argument('--checkpoint-dir', help='Directory holding checkpoints (default: ~/.tree_detector_plugin/checkpoints); checkpoints untouched for a week are deleted')
+    parser.add_argument('--result-file', help='Write detections to this binary file and print only its description instead of GeoJSON')
+    parser.add_argument('--output', help='Stream detections as points into this GeoPackage (.gpkg) or FlatGeobuf (.fgb) file with a spatial index; needs fiona')
+    parser.add_argument('--output-boxes', action='store_true', help='Also store the box bounds as xmin/ymin/xmax/ymax attributes in --output')
+    parser.add_argument('--raw-file', help='Also write every box above --raw-conf, before NMS across tiles, to this binary file')
+    parser.add_argument('--raw-conf', type=float, default=0.05, help='Floor confidence of the boxes kept in --raw-file')
+    parser.add_argument('--raw-iou', type=float, default=0.9, help='IoU above which the model merges boxes within a tile when --raw-file is used')
+    parser.add_argument('--max-det', type=int, default=300, help='Most boxes the model keeps per tile')
+    parser.add_argument('--raw-max-det', type=int, default=3000, help='Most boxes the model keeps per tile when --raw-file is used')
+    parser.add_argument('--profile', help='Write cProfile statistics of the run, merged over the pipeline threads, to this file (view with pstats or snakeviz)')
+    parser.add_argument('--serve', action='store_true', help='Run as a persistent worker that keeps models loaded between jobs')
+    parser.add_argument('--idle-timeout', type=float, default=1800, help='Seconds without a job before the worker exits (with --serve)')
+    parser.add_argument('--max-models', type=int, default=2, help='Number of models kept loaded by the worker (with --serve)')
+    return parser
+
+def parse_args(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.serve:
+        missing = [name for name in ('input', 'model', 'conf', 'iou') if getattr(args, name) is None]
+        if missing:
+            parser.error("the following arguments are required: " + ", ".join('--' + name for name in missing))
+    if args.output and os.path.splitext(args.output)[1].lower() not in OUTPUT_DRIVERS:
+        parser.error("--output must end in " + " or ".join(OUTPUT_DRIVERS))
+    if args.int8 and args.backend != 'onnx':
+        parser.error("--int8 is only supported with --backend onnx")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.serve:
+        serve(args)
+    else:
+        main(args)
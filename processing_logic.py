@@ -1,4 +1,99 @@
-from qgis.core import QgsMessageLog, Qgis
+import collections
+import threading
+
+from qgis.core import QgsMessageLog, QgsRectangle, Qgis
+
+from .external_processor import TileGrid, BucketedNMS, ModelCache, Uint8Converter, collect_detections, load_model
+from .external_processor import process_for_yolo as convert_tile
+
+GeoTransform = collections.namedtuple('GeoTransform', 'a b c d e f')
+
+class ArrayWindowReader:
+    """Window reader over a (bands, rows, cols) array already in memory."""
+
+    def __init__(self, image_array, transform):
+        self.array = image_array[:3]
+        self.count, self.height, self.width = self.array.shape
+        self.dtype = image_array.dtype
+        self.transform = transform
+
+    def read(self, x, y, cols, rows, out):
+        out[...] = self.array[:, y:y + rows, x:x + cols]
+
+    def sample(self, max_size, np):
+        step = max(1, int(max(self.width, self.height) / max_size))
+        return self.array[:, ::step, ::step]
+
+class RasterioWindowReader:
+    """Window reader over an open rasterio dataset; reads only the first three bands."""
+
+    def __init__(self, src):
+        self.src = src
+        self.bands = list(range(1, min(src.count, 3) + 1))
+        self.count = len(self.bands)
+        self.width = src.width
+        self.height = src.height
+        self.dtype = src.dtypes[0]
+        self.transform = src.transform
+
+    def read(self, x, y, cols, rows, out):
+        from rasterio.windows import Window
+        self.src.read(self.bands, window=Window(x, y, cols, rows), out=out)
+
+    def sample(self, max_size, np):
+        factor = max(1.0, max(self.width, self.height) / max_size)
+        out_shape = (self.count, max(1, int(self.height / factor)), max(1, int(self.width / factor)))
+        return self.src.read(self.bands, out_shape=out_shape, masked=True)
+
+class ProviderWindowReader:
+    """Window reader over a QgsRasterDataProvider.
+
+    `bands` lists the red, green and blue bands to read; by default the
+    first three bands (or all of them, for rasters with fewer) are used.
+
+    Providers are not thread safe, so a task should be given
+    `provider.clone()` rather than the layer's own provider.
+    """
+
+    DTYPES = {
+        Qgis.Byte: 'uint8', Qgis.UInt16: 'uint16', Qgis.Int16: 'int16',
+        Qgis.UInt32: 'uint32', Qgis.Int32: 'int32',
+        Qgis.Float32: 'float32', Qgis.Float64: 'float64',
+    }
+
+    def __init__(self, provider, bands=None):
+        self.provider = provider
+        self.bands = bands or list(range(1, min(provider.bandCount(), 3) + 1))
+        for band in self.bands:
+            if not 1 <= band <= provider.bandCount():
+                raise ValueError(f"Band {band} does not exist; the raster has {provider.bandCount()} bands")
+        self.count = len(self.bands)
+        self.width = provider.xSize()
+        self.height = provider.ySize()
+        self.dtype = self.DTYPES[provider.dataType(1)]
+        extent = provider.extent()
+        self.transform = GeoTransform(
+            extent.width() / self.width, 0.0, extent.xMinimum(),
+            0.0, -extent.height() / self.height, extent.yMaximum()
+        )
+
+    def read_extent(self, extent, cols, rows, out, np):
+        for i, band in enumerate(self.bands):
+            block = self.provider.block(band, extent, cols, rows)
+            out[i] = np.frombuffer(bytes(block.data()), dtype=self.dtype).reshape(rows, cols)
+
+    def read(self, x, y, cols, rows, out):
+        import numpy as np
+        t = self.transform
+        extent = QgsRectangle(t.c + x * t.a, t.f + (y + rows) * t.e, t.c + (x + cols) * t.a, t.f + y * t.e)
+        self.read_extent(extent, cols, rows, out, np)
+
+    def sample(self, max_size, np):
+        factor = max(1.0, max(self.width, self.height) / max_size)
+        rows, cols = max(1, int(self.height / factor)), max(1, int(self.width / factor))
+        out = np.empty((self.count, rows, cols), dtype=self.dtype)
+        self.read_extent(self.provider.extent(), cols, rows, out, np)
+        return out
 
 def run_detection_on_array(task, model, image_array, transform, crs_wkt, conf_threshold=0.5, iou_threshold=0.4, tile_size=640, overlap=100):
     """
@@ -6,6 +101,18 @@ def run_detection_on_array(task, model, image_array, transform, crs_wkt, conf_th
     This function is designed to be run in a QgsTask background thread.
     Returns a tuple: (success, data or error_message)
     """
+    return run_detection_on_reader(task, model, ArrayWindowReader(image_array, transform), crs_wkt,
+                                   conf_threshold, iou_threshold, tile_size, overlap)
+
+def run_detection_on_reader(task, model, reader, crs_wkt, conf_threshold=0.5, iou_threshold=0.4, tile_size=640, overlap=100):
+    """
+    Runs YOLO detection over a window reader (ArrayWindowReader,
+    RasterioWindowReader or ProviderWindowReader), pulling one tile at a
+    time into a reused padded buffer, so memory stays at a few tiles
+    whatever the raster size.
+    This function is designed to be run in a QgsTask background thread.
+    Returns a tuple: (success, data or error_message)
+    """
     try:
         import numpy as np
         import cv2
@@ -18,61 +125,67 @@ def run_detection_on_array(task, model, image_array, transform, crs_wkt, conf_th
 
     try:
         QgsMessageLog.logMessage("Starting detection task in background.", "TreeDetector", Qgis.Info)
-        height, width = image_array.shape[1], image_array.shape[2]
+        height, width = reader.height, reader.width
+        transform = reader.transform
         
         all_detections = []
         
-        num_tiles_y = len(range(0, height, tile_size - overlap))
-        num_tiles_x = len(range(0, width, tile_size - overlap))
-        total_tiles = num_tiles_y * num_tiles_x if num_tiles_y > 0 and num_tiles_x > 0 else 1
+        grid = TileGrid(width, height, tile_size, overlap)
+        convert = None
+        if np.dtype(reader.dtype) != np.uint8:
+            # Statistics from a decimated sample, shared by every tile.
+            convert = Uint8Converter.from_sample(reader.sample(1024, np), np)
+        total_tiles = len(grid) or 1
         processed_tiles = 0
         QgsMessageLog.logMessage(f"Processing {total_tiles} tiles...", "TreeDetector", Qgis.Info)
 
-        for y in range(0, height, tile_size - overlap):
-            for x in range(0, width, tile_size - overlap):
-                if task.isCanceled():
-                    return (False, "Task Canceled")
-                
-                y_end = min(y + tile_size, height)
-                x_end = min(x + tile_size, width)
-                
-                tile_np = image_array[:, y:y_end, x:x_end]
-                
-                padded_tile = np.zeros((image_array.shape[0], tile_size, tile_size), dtype=tile_np.dtype)
-                padded_tile[:, :tile_np.shape[1], :tile_np.shape[2]] = tile_np
-                
-                processed_tile = process_for_yolo(padded_tile)
-
-                results = model(processed_tile, verbose=False)
-                
-                for r in results:
-                    for box in r.boxes:
-                        if box.conf[0] < conf_threshold:
-                            continue
-                        x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                        abs_x1, abs_y1 = x + x1, y + y1
-                        abs_x2, abs_y2 = x + x2, y + y2
-                        geo_x1, geo_y1 = transform * (abs_x1, abs_y1)
-                        geo_x2, geo_y2 = transform * (abs_x2, abs_y2)
-
-                        all_detections.append({
-                            'geo_bbox': [geo_x1, geo_y1, geo_x2, geo_y2],
-                            'confidence': float(box.conf[0]),
-                            'class': model.names[int(box.cls[0])]
-                        })
-                
-                processed_tiles += 1
-                if total_tiles > 0:
-                    task.setProgress((processed_tiles / total_tiles) * 100)
-
-        if not all_detections:
-            return (True, [])
+        def nms(detections):
+            boxes = torch.as_tensor(np.stack([detections['x1'], detections['y1'], detections['x2'], detections['y2']], axis=1), dtype=torch.float)
+            scores = torch.as_tensor(detections['confidence'], dtype=torch.float)
+            return np.asarray(ops.nms(boxes, scores, iou_threshold), dtype=np.int64)
+
+        # Cross-tile duplicates are removed per overlap zone as tiles complete
+        # instead of with one NMS over every box of the raster.
+        deduplicator = BucketedNMS(grid, nms, np)
+
+        padded_tile = np.zeros((reader.count, tile_size, tile_size), dtype=reader.dtype)
+        for x, y in grid.offsets():
+            if task.isCanceled():
+                return (False, "Task Canceled")
             
-        boxes = torch.tensor([d['geo_bbox'] for d in all_detections], dtype=torch.float)
-        scores = torch.tensor([d['confidence'] for d in all_detections], dtype=torch.float)
-        keep_indices = ops.nms(boxes, scores, iou_threshold)
+            rows = min(tile_size, height - y)
+            cols = min(tile_size, width - x)
+            reader.read(x, y, cols, rows, padded_tile[:, :rows, :cols])
+            # Clear what earlier, larger tiles left outside this edge tile.
+            padded_tile[:, rows:, :] = 0
+            padded_tile[:, :rows, cols:] = 0
+            
+            processed_tile = process_for_yolo(padded_tile, convert)
+
+            results = model(processed_tile, verbose=False, iou=iou_threshold, agnostic_nms=True)
+            
+            per_tile = collect_detections([(x, y, processed_tile)], results, transform, conf_threshold, grid, np)
+            all_detections.append(deduplicator.add_tile(grid.row_of(y), per_tile[0]))
+            
+            processed_tiles += 1
+            if total_tiles > 0:
+                task.setProgress((processed_tiles / total_tiles) * 100)
+
+        detections = np.concatenate(all_detections) if all_detections else []
+        if len(detections) == 0:
+            return (True, [])
 
-        final_detections = [all_detections[i] for i in keep_indices]
+        final_detections = [
+            {
+                'geo_bbox': [x1, y1, x2, y2],
+                'confidence': confidence,
+                'class': model.names[class_id]
+            }
+            for x1, y1, x2, y2, confidence, class_id in zip(
+                detections['x1'].tolist(), detections['y1'].tolist(),
+                detections['x2'].tolist(), detections['y2'].tolist(),
+                detections['confidence'].tolist(), detections['class_id'].tolist())
+        ]
         QgsMessageLog.logMessage(f"Finished. Found {len(final_detections)} detections after NMS.", "TreeDetector", Qgis.Info)
         return (True, final_detections)
 
@@ -82,31 +195,39 @@ def run_detection_on_array(task, model, image_array, transform, crs_wkt, conf_th
         traceback.print_exc()
         return (False, str(e))
 
-def load_yolo_model(model_path):
-    from ultralytics import YOLO
+def load_yolo_model(model_path, backend='torch', int8=False):
     try:
-        model = YOLO(model_path)
+        model = load_model(model_path, backend, int8)
         return model
     except Exception as e:
         QgsMessageLog.logMessage(f"Error loading YOLO model: {e}", "TreeDetector", Qgis.Critical)
         return None
 
-def process_for_yolo(image_np):
+# Models loaded by in-process runs stay loaded for the next run.
+MODEL_CACHE = ModelCache(load_model, max_models=1)
+_model_lock = threading.Lock()
+
+def run_in_process(task, provider, model_path, crs_wkt, conf_threshold=0.5, iou_threshold=0.4, backend='torch', int8=False, bands=None):
+    """
+    Runs detection inside QGIS, reading tiles from a raster data provider.
+    `provider` must be a clone owned by this task; `bands` are the red,
+    green and blue band numbers. The model is reused across runs as long
+    as the file and backend do not change.
+    Returns a tuple: (success, data or error_message)
+    """
+    try:
+        reader = ProviderWindowReader(provider, bands)
+    except ValueError as e:
+        return (False, str(e))
+    try:
+        with _model_lock:
+            model = MODEL_CACHE.get(model_path, backend, int8)
+    except Exception as e:
+        QgsMessageLog.logMessage(f"Error loading YOLO model: {e}", "TreeDetector", Qgis.Critical)
+        return (False, f"Could not load model: {e}")
+    return run_detection_on_reader(task, model, reader, crs_wkt, conf_threshold, iou_threshold)
+
+def process_for_yolo(image_np, convert=None):
     import cv2
     import numpy as np
-    img = image_np.transpose(1, 2, 0)
-    
-    if img.shape[2] > 3:
-        img = img[:, :, :3]
-        
-    if len(img.shape) == 3 and img.shape[2] == 3:
-        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-
-    if img.dtype != np.uint8:
-        max_val = np.max(img)
-        if max_val > 0:
-             img = (img / max_val * 255).astype(np.uint8)
-        else:
-             img = img.astype(np.uint8)
-    
-    return img
\ No newline at end of file
+    return convert_tile(image_np, cv2, np, convert)
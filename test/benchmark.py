@@ -0,0 +1,371 @@
+# coding=utf-8
+"""Throughput benchmark of the detection pipelines.
+
+Generates synthetic GeoTIFFs and runs them through
+``external_processor.main`` and ``processing_logic.run_detection_on_array``
+with a stub model that emits deterministic boxes, so neither weights nor
+a GPU are needed. Every case runs in its own process so that peak RSS is
+not inherited from earlier cases. Results are written as JSON, e.g.::
+
+    python test/benchmark.py --size 4096 --dtype uint8,uint16 \\
+        --compress none,deflate --nodata 0,0.5 --output bench.json
+
+``run_detection_on_array`` needs QGIS; without it those cases are
+reported as skipped.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'kam_guitar@hotmail.com'
+__date__ = '2025-07-04'
+__copyright__ = 'Copyright 2025, Kampanart Srisuwan'
+
+import argparse
+import collections
+import importlib
+import importlib.util
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+PLUGIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, PLUGIN_DIR)
+import external_processor  # noqa: E402
+
+PIPELINES = ('external', 'in_process')
+
+
+class StubArray:
+    """Stands in for a tensor: ``.cpu().numpy()`` returns the array."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class StubBoxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy, self.conf, self.cls = StubArray(xyxy), StubArray(conf), StubArray(cls)
+
+
+class StubResult:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubModel:
+    """Model with the ultralytics call signature that finds a tree every `spacing` pixels.
+
+    Box confidence follows the first channel at the box centre, so blank
+    and nodata areas yield nothing and every run over the same raster
+    gives the same boxes. `delay` seconds per tile stand in for the cost
+    of real inference.
+    """
+
+    names = {0: 'tree'}
+
+    def __init__(self, np, spacing=80, box_size=40, delay=0.0):
+        self.np = np
+        self.spacing = spacing
+        self.box_size = box_size
+        self.delay = delay
+        self.seconds = 0.0
+        self.calls = 0
+
+    def __call__(self, images, verbose=False, conf=0.25, iou=0.7, **kwargs):
+        np = self.np
+        start = time.perf_counter()
+        images = images if isinstance(images, list) else [images]
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            cy, cx = np.mgrid[self.spacing // 2:height:self.spacing, self.spacing // 2:width:self.spacing]
+            cy, cx = cy.ravel(), cx.ravel()
+            scores = (0.3 + 0.7 * image[cy, cx, 0] / 255.0).astype(np.float32)
+            keep = scores >= conf
+            half = self.box_size / 2
+            xyxy = np.stack([cx - half, cy - half, cx + half, cy + half], axis=1)[keep].astype(np.float32)
+            results.append(StubResult(StubBoxes(xyxy, scores[keep], np.zeros(keep.sum(), dtype=np.float32))))
+        if self.delay:
+            time.sleep(self.delay * len(images))
+        self.seconds += time.perf_counter() - start
+        self.calls += len(images)
+        return results
+
+
+class StubModelCache:
+    """Hands `main` the stub model instead of loading weights."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def get(self, model_path, *options):
+        return self.model
+
+
+class StageTimer:
+    """Accumulates wall time and call counts of wrapped functions, per stage.
+
+    Stages running on different threads overlap, so their times can add
+    up to more than the total.
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.patched = []
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+                self.calls[stage] += 1
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, original))
+
+    def restore(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def report(self):
+        return {stage: {'seconds': round(self.seconds[stage], 4), 'calls': self.calls[stage]} for stage in self.seconds}
+
+
+def write_raster(path, size, dtype, bands, compress, nodata_fraction, seed=0):
+    """Writes a tiled size x size GeoTIFF of bright crowns on darker ground.
+
+    The left `nodata_fraction` of the columns is nodata, which the
+    pipelines should skip.
+    """
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+    from rasterio.windows import Window
+
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        peak = min(np.iinfo(dtype).max, 4095)
+    else:
+        peak = 1.0
+    profile = {
+        'driver': 'GTiff', 'width': size, 'height': size, 'count': bands, 'dtype': dtype,
+        'crs': 'EPSG:32647', 'transform': from_origin(500000, 1500000, 0.1, 0.1),
+        'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'nodata': 0,
+    }
+    if compress != 'none':
+        profile['compress'] = compress
+    rng = np.random.default_rng(seed)
+    nodata_cols = int(size * nodata_fraction)
+    strip = 1024
+    with rasterio.open(path, 'w', **profile) as dst:
+        for y in range(0, size, strip):
+            rows = min(strip, size - y)
+            yy, xx = np.mgrid[y:y + rows, 0:size]
+            crowns = (np.sin(yy / 13.0) * np.cos(xx / 17.0)) ** 2
+            ground = rng.uniform(0.05, 0.3, (rows, size))
+            base = np.maximum(crowns, ground)
+            data = np.stack([base * (0.6 + 0.4 * band / bands) for band in range(bands)])
+            data = np.clip(data * peak, 1, peak).astype(dtype)
+            data[:, :, :nodata_cols] = 0
+            dst.write(data, window=Window(0, y, size, rows))
+
+
+def bench_external(case, raster, model, timer):
+    """Runs `external_processor.main` with a result file and returns (tiles, detections)."""
+    ep = external_processor
+    timer.wrap(ep.TileReader, 'read', 'read')
+    timer.wrap(ep.TileReader, 'prepare', 'preprocess')
+    timer.wrap(ep, 'collect_detections', 'postprocess')
+    timer.wrap(ep.BucketedNMS, 'add_tile', 'nms')
+    with tempfile.TemporaryDirectory() as tmp:
+        argv = ['--input', raster, '--model', 'stub.pt', '--conf', '0.5', '--iou', '0.4',
+                '--batch-size', str(case['batch_size']), '--result-file', os.path.join(tmp, 'result.bin')]
+        out = io.StringIO()
+        ep.main(ep.parse_args(argv), out, StubModelCache(model))
+    result = [line for line in out.getvalue().splitlines() if line.startswith('RESULT:')]
+    detections = json.loads(result[-1][len('RESULT:'):])['count']
+    return timer.calls['read'], detections
+
+
+def load_processing_logic():
+    """Imports processing_logic as part of the plugin package, or returns None without QGIS."""
+    if importlib.util.find_spec('qgis') is None:
+        return None
+    spec = importlib.util.spec_from_file_location(
+        'tree_detector_plugin', os.path.join(PLUGIN_DIR, '__init__.py'), submodule_search_locations=[PLUGIN_DIR])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = package
+    spec.loader.exec_module(package)
+    return importlib.import_module('tree_detector_plugin.processing_logic')
+
+
+class Task:
+    """The parts of QgsTask that run_detection_on_array uses."""
+
+    def isCanceled(self):
+        return False
+
+    def setProgress(self, progress):
+        pass
+
+
+def bench_in_process(case, raster, model, timer):
+    """Runs `run_detection_on_array` over the whole raster and returns (tiles, detections)."""
+    import rasterio
+
+    processing_logic = load_processing_logic()
+    if processing_logic is None:
+        return None
+    with rasterio.open(raster) as src:
+        start = time.perf_counter()
+        image = src.read(list(range(1, min(src.count, 3) + 1)))
+        timer.seconds['read'] += time.perf_counter() - start
+        transform, crs_wkt = src.transform, src.crs.to_wkt()
+    timer.wrap(processing_logic.ArrayWindowReader, 'read', 'read')
+    timer.wrap(processing_logic, 'process_for_yolo', 'preprocess')
+    timer.wrap(processing_logic, 'collect_detections', 'postprocess')
+    timer.wrap(processing_logic.BucketedNMS, 'add_tile', 'nms')
+    ok, detections = processing_logic.run_detection_on_array(Task(), model, image, transform, crs_wkt, 0.5, 0.4)
+    if not ok:
+        raise RuntimeError(detections)
+    return timer.calls['read'], len(detections)
+
+
+def run_case(case):
+    """Runs one benchmark case in this process and returns its result record."""
+    import numpy as np
+
+    with tempfile.TemporaryDirectory() as tmp:
+        raster = os.path.join(tmp, 'synthetic.tif')
+        write_raster(raster, case['size'], case['dtype'], case['bands'], case['compress'], case['nodata'])
+        model = StubModel(np, delay=case['model_ms'] / 1000.0)
+        timer = StageTimer()
+        bench = bench_external if case['pipeline'] == 'external' else bench_in_process
+        start = time.perf_counter()
+        try:
+            outcome = bench(case, raster, model, timer)
+        finally:
+            timer.restore()
+        seconds = time.perf_counter() - start
+
+    record = dict(case)
+    if outcome is None:
+        record['skipped'] = 'QGIS is not available'
+        return record
+    tiles, detections = outcome
+    stages = timer.report()
+    stages['inference'] = {'seconds': round(model.seconds, 4), 'calls': model.calls}
+    record.update(
+        seconds=round(seconds, 4),
+        tiles=tiles,
+        tiles_per_second=round(tiles / seconds, 2) if seconds else None,
+        detections=detections,
+        stages=stages,
+        peak_rss_mb=external_processor.peak_rss_mb(),
+    )
+    return record
+
+
+def environment():
+    """Versions and machine details recorded with the results."""
+    import numpy as np
+
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+    }
+    for name in ('rasterio', 'cv2', 'torch'):
+        try:
+            info[name] = getattr(importlib.import_module(name), '__version__', None)
+        except ImportError:
+            info[name] = None
+    try:
+        info['commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=PLUGIN_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info['commit'] = None
+    return info
+
+
+def comma_list(cast):
+    return lambda value: [cast(item) for item in value.split(',')]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pipeline', type=comma_list(str), default=list(PIPELINES), help='Comma-separated pipelines: external, in_process')
+    parser.add_argument('--size', type=comma_list(int), default=[4096], help='Comma-separated raster widths (square rasters)')
+    parser.add_argument('--dtype', type=comma_list(str), default=['uint8'], help='Comma-separated raster data types')
+    parser.add_argument('--bands', type=comma_list(int), default=[3], help='Comma-separated band counts')
+    parser.add_argument('--compress', type=comma_list(str), default=['none'], help='Comma-separated GeoTIFF compressions, e.g. none,deflate,lzw')
+    parser.add_argument('--nodata', type=comma_list(float), default=[0.0], help='Comma-separated nodata fractions')
+    parser.add_argument('--batch-size', type=int, default=8, help='Batch size of the external pipeline')
+    parser.add_argument('--model-ms', type=float, default=0.0, help='Simulated inference time per tile in milliseconds')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs of every case')
+    parser.add_argument('--output', help='JSON file for the results; printed to stdout when omitted')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    unknown = set(args.pipeline) - set(PIPELINES)
+    if unknown:
+        parser.error("unknown pipeline: " + ", ".join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return
+
+    results = []
+    for pipeline, size, dtype, bands, compress, nodata in itertools.product(
+            args.pipeline, args.size, args.dtype, args.bands, args.compress, args.nodata):
+        case = {
+            'pipeline': pipeline, 'size': size, 'dtype': dtype, 'bands': bands, 'compress': compress,
+            'nodata': nodata, 'batch_size': args.batch_size, 'model_ms': args.model_ms,
+        }
+        for run in range(args.repeat):
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+                capture_output=True, text=True)
+            if completed.returncode:
+                record = dict(case, error=completed.stderr.strip().splitlines()[-1:])
+            else:
+                record = json.loads(completed.stdout.strip().splitlines()[-1])
+            record['run'] = run
+            results.append(record)
+            print(json.dumps(record), file=sys.stderr)
+
+    report = json.dumps({'environment': environment(), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+# coding=utf-8
+"""External processor test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'kam_guitar@hotmail.com'
+__date__ = '2025-07-04'
+__copyright__ = 'Copyright 2025, Kampanart Srisuwan'
+
+import importlib.util
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+from affine import Affine
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import external_processor  # noqa: E402
+
+
+def numpy_nms(detections, iou):
+    """Reference greedy NMS over BOX_FIELDS records."""
+    boxes = np.stack([detections['x1'], detections['y1'], detections['x2'], detections['y2']], axis=1)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-detections['confidence'], kind='stable')
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.clip(np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0]), 0, None)
+        h = np.clip(np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1]), 0, None)
+        inter = w * h
+        order = rest[inter / (areas[i] + areas[rest] - inter) <= iou]
+    return np.array(keep, dtype=np.int64)
+
+
+def greedy_nms(boxes, scores, iou, block_size=262144):
+    """Greedy NMS built from the overlap graph, as the dialog re-filters raw detections."""
+    order, sources, targets, _ = external_processor.overlap_graph(boxes, scores, np, iou, block_size)
+    return order[external_processor.resolve_suppression(len(order), sources, targets, np)]
+
+
+def memory_raster(width, height, crs='EPSG:32647', gsd=0.1, bands=None, nodata=None):
+    """Opens an in-memory float32 raster whose bands hold each pixel's column and row."""
+    from rasterio.io import MemoryFile
+    from rasterio.transform import from_origin
+
+    if bands is None:
+        rows, cols = np.mgrid[0:height, 0:width].astype(np.float32)
+        bands = np.stack([cols, rows])
+    memory = MemoryFile()
+    with memory.open(driver='GTiff', width=width, height=height, count=len(bands), dtype=bands.dtype.name,
+                     crs=crs, transform=from_origin(500000, 1500000, gsd, gsd), nodata=nodata,
+                     tiled=True, blockxsize=128, blockysize=128) as dst:
+        dst.write(bands)
+    return memory.open()
+
+
+def dilate(mask, radius):
+    """Grows the True pixels of `mask` by `radius` pixels in every direction."""
+    for axis in (0, 1):
+        grown = mask.copy()
+        for shift in range(1, radius + 1):
+            lead = [slice(None)] * 2
+            lag = [slice(None)] * 2
+            lead[axis], lag[axis] = slice(shift, None), slice(None, -shift)
+            grown[tuple(lead)] |= mask[tuple(lag)]
+            grown[tuple(lag)] |= mask[tuple(lead)]
+        mask = grown
+    return mask
+
+
+def tiles_touching(grid, mask, pixel_scale=1):
+    """Flags the tiles of `grid` whose footprint holds a True pixel of the full-resolution `mask`."""
+    result = np.zeros((grid.rows, grid.cols), dtype=bool)
+    for row in range(grid.rows):
+        for col in range(grid.cols):
+            x0, y0 = int(col * grid.step * pixel_scale), int(row * grid.step * pixel_scale)
+            size = int(np.ceil(grid.tile_size * pixel_scale))
+            result[row, col] = mask[y0:y0 + size, x0:x0 + size].any()
+    return result
+
+
+def failing_loader(model_path, backend, int8):
+    """Model loader standing in for a broken weights file."""
+    raise RuntimeError(f"cannot load {model_path}")
+
+
+def simulate_tiles(grid, seed, n=3000, sizes=(20, 90), iou=0.4):
+    """Detects random crowns in every tile that sees them, with per-tile NMS like the model."""
+    rng = np.random.default_rng(seed)
+    size = rng.uniform(*sizes, n)
+    cx = rng.uniform(0, grid.width, n)
+    cy = rng.uniform(0, grid.height, n)
+    crowns = np.stack([cx - size / 2, cy - size / 2, cx + size / 2, cy + size / 2], axis=1)
+
+    tiles = []
+    for x0, y0 in grid.offsets():
+        x1 = min(x0 + grid.tile_size, grid.width)
+        y1 = min(y0 + grid.tile_size, grid.height)
+        local = np.clip(crowns - [x0, y0, x0, y0], 0, [x1 - x0, y1 - y0, x1 - x0, y1 - y0])
+        visible = ((local[:, 2] - local[:, 0]) > 10) & ((local[:, 3] - local[:, 1]) > 10)
+        local = local[visible] + rng.normal(0, 2, (visible.sum(), 4))
+
+        detections = np.empty(len(local), dtype=np.dtype(external_processor.BOX_FIELDS))
+        detections['x1'], detections['y1'], detections['x2'], detections['y2'] = (local + [x0, y0, x0, y0]).T
+        detections['confidence'] = rng.uniform(0.3, 1.0, len(local))
+        detections['class_id'] = 0
+        detections['px'] = x0 + (local[:, 0] + local[:, 2]) / 2
+        detections['py'] = y0 + (local[:, 1] + local[:, 3]) / 2
+        detections['interior'] = grid.interior(local, x0, y0)
+        tiles.append((grid.row_of(y0), detections[numpy_nms(detections, iou)]))
+    return tiles
+
+
+class ExternalProcessorTest(unittest.TestCase):
+    """Test the array post-processing of the external processor."""
+
+    def test_georeference_boxes_rotated(self):
+        """Rotated transforms yield the bounds of all four corners."""
+        transform = Affine.translation(100, 200) * Affine.rotation(30) * Affine.scale(0.1, -0.1)
+        bounds = external_processor.georeference_boxes(np.array([[10., 20., 40., 60.]]), 5, 7, transform, np)
+        corners = np.array([transform * (x + 5, y + 7) for x in (10, 40) for y in (20, 60)])
+        expected = [corners[:, 0].min(), corners[:, 1].min(), corners[:, 0].max(), corners[:, 1].max()]
+        np.testing.assert_allclose(bounds[0], expected)
+
+    def test_bucketed_nms_matches_global_nms(self):
+        """Bucketed NMS over tiles in any order matches one global NMS."""
+        grid = external_processor.TileGrid(2900, 2300, 640, 100)
+        tiles = simulate_tiles(grid, seed=1)
+        order = np.random.default_rng(2).permutation(len(tiles))
+
+        deduplicator = external_processor.BucketedNMS(grid, lambda d: numpy_nms(d, 0.4), np)
+        result = np.concatenate([deduplicator.add_tile(*tiles[i]) for i in order])
+
+        everything = np.concatenate([detections for _, detections in tiles])
+        expected = everything[numpy_nms(everything, 0.4)]
+        self.assertEqual(sorted(result['confidence'].tolist()), sorted(expected['confidence'].tolist()))
+
+    def test_bucketed_nms_large_crowns(self):
+        """Crowns wider than the tile overlap are still de-duplicated against every tile that sees them."""
+        grid = external_processor.TileGrid(2900, 2300, 640, 100)
+        for seed, iou in ((6, 0.3), (7, 0.2)):
+            tiles = simulate_tiles(grid, seed, n=150, sizes=(100, 400), iou=iou)
+            order = np.random.default_rng(seed).permutation(len(tiles))
+
+            deduplicator = external_processor.BucketedNMS(grid, lambda d: numpy_nms(d, iou), np)
+            result = np.concatenate([deduplicator.add_tile(*tiles[i]) for i in order])
+
+            everything = np.concatenate([detections for _, detections in tiles])
+            expected = everything[numpy_nms(everything, iou)]
+            self.assertEqual(sorted(result['confidence'].tolist()), sorted(expected['confidence'].tolist()))
+
+    def test_checkpoint_replay_matches_full_run(self):
+        """A run resumed from a checkpoint finds the same trees as one that was never interrupted."""
+        grid = external_processor.TileGrid(2900, 2300, 640, 100)
+        tiles = [(x, y, detections) for (x, y), (_, detections) in zip(grid.offsets(), simulate_tiles(grid, seed=8))]
+        nms = lambda d: numpy_nms(d, 0.4)
+
+        full = external_processor.BucketedNMS(grid, nms, np)
+        expected = np.concatenate([full.add_tile(grid.row_of(y), detections) for x, y, detections in tiles])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.sqlite')
+            interrupted = external_processor.CheckpointStore(path, np)
+            interrupted.save(tiles[:len(tiles) // 2])
+            interrupted.close()
+            resumed_store = external_processor.CheckpointStore(path, np)
+            completed = resumed_store.load()
+            resumed_store.close()
+        self.assertEqual(len(completed), len(tiles) // 2)
+
+        # Like main: checkpointed tiles are replayed first, then the rest run.
+        resumed = external_processor.BucketedNMS(grid, nms, np)
+        replay = [(x, y, completed.pop((x, y))) for x, y, _ in tiles if (x, y) in completed]
+        rest = tiles[len(replay):]
+        result = np.concatenate([resumed.add_tile(grid.row_of(y), detections) for x, y, detections in replay + rest])
+        np.testing.assert_array_equal(np.sort(result, order=['py', 'px']), np.sort(expected, order=['py', 'px']))
+
+    def test_resample_scale(self):
+        """Finer rasters are decimated to the target GSD; coarser, unprojected or untargeted ones are not."""
+        with memory_raster(64, 64, gsd=0.1) as src:
+            self.assertAlmostEqual(external_processor.resample_scale(src, 0.3), 3.0)
+            self.assertEqual(external_processor.resample_scale(src, 0.05), 1.0)
+            self.assertEqual(external_processor.resample_scale(src, 0.1), 1.0)
+            self.assertEqual(external_processor.resample_scale(src, None), 1.0)
+        with memory_raster(64, 64, crs='EPSG:4326', gsd=1e-6) as src:
+            self.assertEqual(external_processor.resample_scale(src, 0.3), 1.0)
+
+    def test_decimated_tiles_georeference(self):
+        """Tiles read at a coarser GSD cover the raster to its edges and line up with their transform."""
+        import rasterio
+        with memory_raster(1000, 700) as src:
+            reader = external_processor.TileReader(256, [1, 2], 'float32', scale=2.5)
+            self.assertEqual(reader.size(src), (400, 280))
+            transform = reader.transform(src)
+            self.assertEqual(transform * (0, 0), src.transform * (0, 0))
+            np.testing.assert_allclose(transform * (400, 280), src.transform * (1000, 700))
+
+            grid = external_processor.TileGrid(*reader.size(src), 256, 32)
+            buffer = reader.new_buffer(np)
+            for x, y in grid.offsets():
+                tile = reader.read(src, x, y, buffer, rasterio)
+                self.assertEqual(tile.shape[:2], (min(256, 280 - y), min(256, 400 - x)))
+                # Each tile pixel averages the source pixels under it, whose
+                # bands hold their own column and row.
+                rows, cols = np.mgrid[y:y + tile.shape[0], x:x + tile.shape[1]]
+                centres = np.stack(~src.transform * (transform * (cols + 0.5, rows + 0.5)))
+                np.testing.assert_allclose(tile[:, :, 0], centres[0] - 0.5, atol=0.25)
+                np.testing.assert_allclose(tile[:, :, 1], centres[1] - 0.5, atol=0.25)
+
+    def test_valid_tile_mask(self):
+        """Every tile holding a valid pixel is kept, even a thin sliver; tiles well away from data are skipped."""
+        valid = np.zeros((1500, 2000), dtype=bool)
+        valid[100:600, 700:1300] = True
+        valid[:, 1990:1992] = True
+        bands = np.where(valid, 200, 0).astype(np.uint8)[None].repeat(3, axis=0)
+        with memory_raster(2000, 1500, bands=bands, nodata=0) as src:
+            for pixel_scale in (1, 2):
+                grid = external_processor.TileGrid(2000 // pixel_scale, 1500 // pixel_scale, 256 // pixel_scale, 32 // pixel_scale)
+                mask = external_processor.valid_tile_mask(src, grid, np, max_size=256, pixel_scale=pixel_scale)
+                # The mask is read 8x decimated and widened by one coarse pixel.
+                near = dilate(valid, 16)
+                self.assertFalse((tiles_touching(grid, valid, pixel_scale) & ~mask).any())
+                self.assertFalse((mask & ~tiles_touching(grid, near, pixel_scale)).any())
+                self.assertLess(mask.sum(), mask.size)
+
+        with memory_raster(300, 300) as src:
+            self.assertIsNone(external_processor.valid_tile_mask(src, external_processor.TileGrid(300, 300, 128, 16), np))
+
+    def test_aoi_tile_mask(self):
+        """Only tiles whose footprint, clipped to the raster, meets the area of interest are processed."""
+        from shapely.geometry import box
+        transform = Affine.translation(500000, 1500000) * Affine.scale(0.1, -0.1)
+        grid = external_processor.TileGrid(2000, 1500, 256, 32)
+        # Pixels 700-1300 x 100-600, plus an area past the raster's right edge.
+        aoi = box(500070, 1499940, 500130, 1499990).union(box(500202, 1499900, 500300, 1499950))
+        inside = np.zeros((1500, 2000), dtype=bool)
+        inside[101:600, 701:1300] = True
+        np.testing.assert_array_equal(external_processor.aoi_tile_mask(aoi, grid, transform, np), tiles_touching(grid, inside))
+
+    def test_aligned_overlap(self):
+        """Aligned tiles start on block boundaries with at least the requested overlap."""
+        for block_shape in ((256, 256), (512, 512), (128, 256), (64, 96)):
+            overlap = external_processor.aligned_overlap(block_shape, 640, 100)
+            self.assertGreaterEqual(overlap, 100)
+            grid = external_processor.TileGrid(5000, 5000, 640, overlap)
+            for x, y in grid.offsets():
+                self.assertEqual((y % block_shape[0], x % block_shape[1]), (0, 0))
+        # Blocks wider than the step, such as striped TIFF rows, leave the overlap alone.
+        self.assertEqual(external_processor.aligned_overlap((1, 5000), 640, 100), 100)
+        self.assertEqual(external_processor.aligned_overlap((1024, 1024), 640, 100), 100)
+
+    def test_prune_checkpoints(self):
+        """Checkpoints of abandoned runs are deleted once they are old; recent ones are kept."""
+        with tempfile.TemporaryDirectory() as directory:
+            paths = {name: os.path.join(directory, name) for name in ('old.sqlite', 'old.sqlite-journal', 'recent.sqlite', 'notes.txt')}
+            for path in paths.values():
+                open(path, 'w').close()
+            stale = time.time() - external_processor.CHECKPOINT_MAX_AGE - 60
+            for name in ('old.sqlite', 'old.sqlite-journal', 'notes.txt'):
+                os.utime(paths[name], (stale, stale))
+            external_processor.prune_checkpoints(directory)
+            self.assertEqual(sorted(os.listdir(directory)), ['notes.txt', 'recent.sqlite'])
+
+    def test_greedy_nms_matches_reference(self):
+        """Vectorized NMS over raw detections keeps the same boxes as sequential NMS."""
+        grid = external_processor.TileGrid(2900, 2300, 640, 100)
+        raw = np.concatenate([detections for _, detections in simulate_tiles(grid, seed=3)])
+        boxes = np.stack([raw['x1'], raw['y1'], raw['x2'], raw['y2']], axis=1)
+        for iou in (0.2, 0.4, 0.7):
+            keep = greedy_nms(boxes, raw['confidence'], iou, block_size=1000)
+            self.assertEqual(sorted(keep.tolist()), sorted(numpy_nms(raw, iou).tolist()))
+
+    def test_greedy_nms_with_large_boxes(self):
+        """A few tile-sized boxes among small crowns are still compared with everything they touch."""
+        grid = external_processor.TileGrid(2900, 2300, 640, 100)
+        raw = np.concatenate([detections for _, detections in simulate_tiles(grid, seed=5)])
+        large = np.zeros(3, dtype=raw.dtype)
+        large['x1'], large['y1'] = [400, 700, 2300], [300, 500, 1700]
+        large['x2'], large['y2'] = large['x1'] + 640, large['y1'] + 640
+        large['confidence'] = [0.05, 0.99, 0.5]
+        raw = np.concatenate([raw, large])
+        boxes = np.stack([raw['x1'], raw['y1'], raw['x2'], raw['y2']], axis=1)
+        for iou in (0.0, 0.2, 0.4):
+            keep = greedy_nms(boxes, raw['confidence'], iou, block_size=1000)
+            self.assertEqual(sorted(keep.tolist()), sorted(numpy_nms(raw, iou).tolist()))
+
+    @unittest.skipUnless(importlib.util.find_spec('torch'), "shard workers need torch")
+    def test_shard_pool_reports_model_load_error(self):
+        """A model that fails to load in the workers is raised to the parent instead of hanging the pool."""
+        args = external_processor.parse_args([
+            '--input', 'unused.tif', '--model', 'broken.pt', '--conf', '0.5', '--iou', '0.4',
+            '--workers', '2', '--gdal-cache', '64'
+        ])
+        with external_processor.start_shard_pool(args, failing_loader) as pool:
+            with self.assertRaisesRegex(RuntimeError, 'cannot load broken.pt'):
+                pool.apply_async(external_processor.shard_class_names).get(timeout=60)
+
+    def test_profiled_stage_inside_profiled_run(self):
+        """Pipeline stages can be profiled while the whole run is profiled too."""
+        telemetry = external_processor.Telemetry(io.StringIO(), profile=True)
+        errors = []
+
+        def run():
+            stage = telemetry.profiled(lambda: sum(range(10000)))
+            external_processor.start_stage('stage', stage, threading.Event(), errors).join()
+
+        telemetry.profiled(run)()
+        self.assertEqual(errors, [])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'run.prof')
+            telemetry.dump_profile(path)
+            self.assertGreater(os.path.getsize(path), 0)
+
+    def test_uint8_converter_lookup_matches_stretch(self):
+        """16-bit lookup tables give the same pixels as the float stretch."""
+        rng = np.random.default_rng(4)
+        for dtype in ('uint16', 'int16'):
+            tile = rng.integers(-500 if dtype == 'int16' else 0, 4000, (3, 64, 64)).astype(dtype)
+            sample = np.ma.masked_equal(tile, 0)
+            convert = external_processor.Uint8Converter.from_sample(sample, np)
+            self.assertIsNotNone(convert.lut)
+            expected = np.clip((tile.astype(np.float64) - convert.lo) * convert.scale, 0, 255).astype(np.uint8)
+            np.testing.assert_array_equal(convert(tile, np), expected)
+            np.testing.assert_array_equal(convert(tile.astype(np.float32), np), expected)
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(ExternalProcessorTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
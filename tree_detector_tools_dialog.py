@@ -1,50 +1,98 @@
 import os
+import argparse
+import collections
+import importlib.util
+import queue
 import tempfile
 import subprocess
 import json
 import platform
-from qgis.PyQt.QtWidgets import QDialog, QLineEdit, QPushButton, QFileDialog
-from qgis.PyQt.QtCore import QVariant, Qt
+import socket
+import threading
+import time
+import numpy as np
+from qgis.PyQt.QtWidgets import QDialog, QLineEdit, QPushButton, QFileDialog, QSpinBox, QDoubleSpinBox, QCheckBox, QComboBox
+from qgis.PyQt.QtCore import QVariant, Qt, QObject, QTimer, pyqtSignal
 from qgis.core import (QgsProject, QgsVectorLayer, QgsField, QgsFeature, 
                        QgsGeometry, QgsPointXY, QgsRasterLayer, QgsWkbTypes,
                        QgsTask, QgsApplication, QgsMessageLog, Qgis,
-                       QgsMapLayerProxyModel)
-from qgis.gui import QgsMapLayerComboBox
+                       QgsMapLayerProxyModel, QgsCoordinateTransform)
+from qgis.gui import QgsMapLayerComboBox, QgsFileWidget, QgsCheckableComboBox
 
 from .ui_tree_detector_tools_dialog_base import Ui_TreeDetectorDialogBase
+from .external_processor import RAW_FIELDS, DETECTION_FIELDS, band_list, model_gsd, overlap_graph, resolve_suppression
+from .processing_logic import run_in_process
 
-def run_external_script(task, python_path, script_path, input_raster, model_path, confidence, iou):
+CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".tree_detector_plugin")
+WORKER_STATE_PATH = os.path.join(CONFIG_DIR, "worker.json")
+# Seconds the worker gets to accept a job before the script runs on its own.
+WORKER_REPLY_TIMEOUT = 10
 
-    QgsMessageLog.logMessage(f"Starting external script: {script_path}", "TreeDetector", Qgis.Info)
-    
-    command = [
-        python_path,
-        script_path,
-        '--input', input_raster,
-        '--model', model_path,
-        '--conf', str(confidence),
-        '--iou', str(iou)
-    ]
-    
+# Auto mode runs rasters up to this many pixels inside QGIS.
+IN_PROCESS_MAX_PIXELS = 4096 * 4096
+IN_PROCESS_MODULES = ('ultralytics', 'torch', 'torchvision', 'cv2')
+
+def build_script_args(options):
+    """Turns a dict of options into external_processor.py arguments.
+
+    Keys map to --dashed-flags; True becomes a bare flag, lists become a
+    flag followed by every item and None/False options are left out.
+    """
+    args = []
+    for name, value in options.items():
+        if value is None or value is False:
+            continue
+        flag = '--' + name.replace('_', '-')
+        if value is True:
+            args.append(flag)
+        elif isinstance(value, (list, tuple)):
+            args.append(flag)
+            args.extend(str(item) for item in value)
+        else:
+            args.extend([flag, str(value)])
+    return args
+
+def external_env():
     env = os.environ.copy()
     env.pop('PYTHONHOME', None)
     env.pop('PYTHONPATH', None)
-    
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        encoding='utf-8',
-        env=env
-    )
+    return env
+
+class ResultFeed(QObject):
+    """Carries result-file events from the detection task thread to the dialog.
 
-    json_output = ""
-    for line in iter(process.stdout.readline, ''):
+    Signals emitted from the task thread are queued to the dialog's thread,
+    where the new records are read and added to the result layer.
+    """
+    fileAnnounced = pyqtSignal(dict)
+    chunkReady = pyqtSignal(int, int)
+    telemetryReceived = pyqtSignal(dict)
+    fileStarted = pyqtSignal(int, int, str)
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def format_telemetry(telemetry):
+    """One log line from a TELEMETRY record: throughput, ETA, stage times and memory."""
+    stages = ", ".join(f"{name} {seconds:.1f} s" for name, seconds in telemetry['stages'].items())
+    eta = "" if telemetry['final'] or telemetry['eta'] is None else f", ETA {format_duration(telemetry['eta'])}"
+    rss = "" if telemetry['peak_rss_mb'] is None else f"; peak memory {telemetry['peak_rss_mb']:.0f} MB"
+    return (f"{telemetry['tiles']}/{telemetry['total']} tiles in {format_duration(telemetry['elapsed'])}, "
+            f"{telemetry['tiles_per_second']:.1f} tiles/s{eta}; {stages}{rss}")
+
+def consume_output(task, lines, feed=None):
+    """Forwards PROGRESS lines to the task and result chunks and telemetry to `feed`.
+
+    Returns every other output line, or None if the task was canceled
+    while reading.
+    """
+    output = []
+    for line in lines:
         line = line.strip()
         if task.isCanceled():
-            process.kill()
-            return {'success': False, 'error': 'Task Canceled'}
+            return None
 
         if line.startswith('PROGRESS:'):
             try:
@@ -52,24 +100,362 @@ def run_external_script(task, python_path, script_path, input_raster, model_path
                 task.setProgress(progress)
             except (ValueError, IndexError):
                 pass
+        elif line.startswith('SKIPPED:'):
+            skipped = json.loads(line[len('SKIPPED:'):])
+            QgsMessageLog.logMessage(
+                f"Skipping {skipped['tiles']} of {skipped['total']} tiles: {skipped['empty']} without valid pixels, "
+                f"{skipped['outside_aoi']} outside the Area of Interest.", "TreeDetector", Qgis.Info)
+        elif line.startswith('RESAMPLED:'):
+            resampled = json.loads(line[len('RESAMPLED:'):])
+            QgsMessageLog.logMessage(f"Reading at {resampled['gsd']} m, {resampled['scale']:.2f} raster pixels per model pixel.", "TreeDetector", Qgis.Info)
+        elif line.startswith('RESUMED:'):
+            resumed = json.loads(line[len('RESUMED:'):])
+            QgsMessageLog.logMessage(f"Resuming: {resumed['tiles']} of {resumed['total']} tiles restored from checkpoint.", "TreeDetector", Qgis.Info)
+        elif line.startswith('FILE:'):
+            started = json.loads(line[len('FILE:'):])
+            QgsMessageLog.logMessage(f"Processing raster {started['index'] + 1} of {started['count']}: {started['path']}", "TreeDetector", Qgis.Info)
+            if feed:
+                feed.fileStarted.emit(started['index'], started['count'], started['path'])
+        elif line.startswith('TELEMETRY:'):
+            telemetry = json.loads(line[len('TELEMETRY:'):])
+            QgsMessageLog.logMessage(f"Telemetry: {format_telemetry(telemetry)}", "TreeDetector", Qgis.Info)
+            if feed:
+                feed.telemetryReceived.emit(telemetry)
+        elif line.startswith('RESULT_FILE:'):
+            if feed:
+                feed.fileAnnounced.emit(json.loads(line[len('RESULT_FILE:'):]))
+        elif line.startswith('CHUNK:'):
+            if feed:
+                chunk = json.loads(line[len('CHUNK:'):])
+                feed.chunkReady.emit(chunk['offset'], chunk['count'])
         else:
-            json_output += line
+            output.append(line)
+    if task.isCanceled():
+        return None
+    return output
+
+def new_result_file(prefix='tree_detections_'):
+    fd, path = tempfile.mkstemp(prefix=prefix, suffix='.bin')
+    os.close(fd)
+    return path
+
+def result_dtype(info):
+    return np.dtype([tuple(field) for field in info['dtype']])
+
+def read_result_records(path, dtype, offset, count):
+    """Memory-maps `count` records starting at record `offset` of a result file."""
+    if count <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset * dtype.itemsize, shape=(count,))
+
+def load_result(output):
+    """Reads the summary of the binary result file from the script's RESULT line."""
+    result_lines = [line for line in output if line.startswith('RESULT:')]
+    if not result_lines:
+        error_message = f"The external script did not report a result.\nOutput: {' '.join(output)[-2000:]}"
+        QgsMessageLog.logMessage(error_message, "TreeDetector", Qgis.Critical)
+        return {'success': False, 'error': error_message}
+
+    info = json.loads(result_lines[-1][len('RESULT:'):])
+    if 'output' in info:
+        return {'success': True, 'count': info['count'], 'output': info['output'], 'layer': info['layer']}
+    return {
+        'success': True,
+        'count': info['count'],
+        'dtype': result_dtype(info),
+        'class_names': {int(k): v for k, v in info['classes'].items()},
+        'result_file': info['path']
+    }
+
+def in_process_available():
+    """True if QGIS's own Python can run the model."""
+    return all(importlib.util.find_spec(name) is not None for name in IN_PROCESS_MODULES)
+
+def in_process_records(detections):
+    """Turns the detection dicts of an in-process run into result records and class names."""
+    names = sorted({d['class'] for d in detections})
+    class_ids = {name: i for i, name in enumerate(names)}
+    records = np.empty(len(detections), dtype=np.dtype(DETECTION_FIELDS))
+    bboxes = np.array([d['geo_bbox'] for d in detections], dtype=np.float64).reshape(-1, 4)
+    records['x'] = (bboxes[:, 0] + bboxes[:, 2]) / 2
+    records['y'] = (bboxes[:, 1] + bboxes[:, 3]) / 2
+    records['confidence'] = [d['confidence'] for d in detections]
+    records['class_id'] = [class_ids[d['class']] for d in detections]
+    return records, dict(enumerate(names))
+
+def build_raw_index(task, raw_path):
+    """Loads the raw detections of a run and finds their overlaps once.
+
+    Re-applying confidence and IoU thresholds afterwards only has to filter
+    the overlap edges and resolve them, which takes well under a second
+    even for millions of boxes.
+    """
+    try:
+        raw = np.fromfile(raw_path, dtype=np.dtype(RAW_FIELDS))
+    finally:
+        remove_result_file(raw_path)
+    boxes = np.stack([raw['x1'], raw['y1'], raw['x2'], raw['y2']], axis=1)
+    order, sources, targets, ious = overlap_graph(boxes, raw['confidence'], np)
+    raw = raw[order]
+
+    records = np.empty(len(raw), dtype=np.dtype(DETECTION_FIELDS))
+    records['x'] = (raw['x1'] + raw['x2']) / 2
+    records['y'] = (raw['y1'] + raw['y2']) / 2
+    records['confidence'] = raw['confidence']
+    records['class_id'] = raw['class_id']
+    return {'records': records, 'sources': sources, 'targets': targets, 'ious': ious}
+
+def write_aoi_file(geometries):
+    """Writes AOI polygons, already in the raster CRS, to a temporary GeoJSON file."""
+    fd, path = tempfile.mkstemp(prefix='tree_aoi_', suffix='.geojson')
+    features = [{'type': 'Feature', 'properties': {}, 'geometry': json.loads(geometry.asJson())}
+                for geometry in geometries]
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return path
+
+def remove_result_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def start_pipe_reader(pipe, handle_line):
+    """Calls `handle_line` with every line of `pipe` from a daemon thread until EOF."""
+    def read():
+        with pipe:
+            for line in iter(pipe.readline, ''):
+                handle_line(line)
+        handle_line(None)
+
+    thread = threading.Thread(target=read, daemon=True)
+    thread.start()
+    return thread
+
+def process_lines(task, stdout_lines, poll_interval=0.25):
+    """Yields the script's stdout lines from `stdout_lines`, checking for cancellation at least every `poll_interval` seconds.
+
+    A None item marks the end of stdout.
+    """
+    while True:
+        try:
+            line = stdout_lines.get(timeout=poll_interval)
+        except queue.Empty:
+            if task.isCanceled():
+                return
+            continue
+        if line is None:
+            return
+        yield line
+
+def stop_process(process, timeout=2):
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def run_external_script(task, python_path, script_path, options, feed=None):
+    """Runs external_processor.py in a new process and reads its output protocol.
+
+    stdout and stderr are drained by their own threads so that neither
+    pipe can fill up and stall the script; stderr goes to the message log
+    as it arrives. Cancellation is noticed within a fraction of a second,
+    even while the script is busy in a long inference call.
+    """
+    QgsMessageLog.logMessage(f"Starting external script: {script_path}", "TreeDetector", Qgis.Info)
+    
+    command = [python_path, script_path] + build_script_args(options)
+    
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        env=external_env()
+    )
+
+    stdout_lines = queue.Queue()
+    stderr_tail = collections.deque(maxlen=50)
+
+    def log_stderr(line):
+        if line is not None and line.strip():
+            stderr_tail.append(line.rstrip())
+            QgsMessageLog.logMessage(f"External script: {line.rstrip()}", "TreeDetector", Qgis.Info)
+
+    start_pipe_reader(process.stdout, stdout_lines.put)
+    stderr_reader = start_pipe_reader(process.stderr, log_stderr)
+
+    output = consume_output(task, process_lines(task, stdout_lines), feed)
+    if output is None:
+        stop_process(process)
+        return {'success': False, 'error': 'Task Canceled'}
 
     process.wait()
+    stderr_reader.join()
 
     if process.returncode != 0:
-        error_message = f"External script failed with exit code {process.returncode}.\nStderr: {process.stderr.read()}"
+        stderr = "\n".join(stderr_tail)
+        error_message = f"External script failed with exit code {process.returncode}.\nStderr: {stderr}"
         QgsMessageLog.logMessage(error_message, "TreeDetector", Qgis.Critical)
         return {'success': False, 'error': error_message}
 
+    return load_result(output)
+
+def read_worker_state():
+    try:
+        with open(WORKER_STATE_PATH, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def worker_matches(state, python_path, script_path):
+    same_python = os.path.normcase(os.path.abspath(state.get('python', ''))) == os.path.normcase(os.path.abspath(python_path))
+    same_script = state.get('script') == os.path.abspath(script_path) and state.get('script_mtime') == os.path.getmtime(script_path)
+    return same_python and same_script
+
+def send_worker_request(state, request, timeout=5):
+    conn = socket.create_connection(('127.0.0.1', state['port']), timeout=timeout)
+    request = dict(request, token=state['token'])
+    conn.sendall((json.dumps(request) + "\n").encode('utf-8'))
+    return conn
+
+def spawn_worker(task, python_path, script_path, timeout=180):
+    """Starts a detached worker and waits until it has published its address."""
+    kwargs = {}
+    if platform.system() == 'Windows':
+        kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS
+    else:
+        kwargs['start_new_session'] = True
+
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    with open(os.path.join(CONFIG_DIR, 'worker.log'), 'a') as log:
+        process = subprocess.Popen(
+            [python_path, script_path, '--serve'],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            env=external_env(),
+            **kwargs
+        )
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if task.isCanceled() or process.poll() is not None:
+            return None
+        state = read_worker_state()
+        if state and state.get('pid') == process.pid:
+            return state
+        time.sleep(0.2)
+    return None
+
+def connect_worker(task, python_path, script_path, request):
+    """Sends `request` to a running worker, starting a new one if needed."""
+    state = read_worker_state()
+    if state and not worker_matches(state, python_path, script_path):
+        # Started from another environment or an older plugin version.
+        try:
+            send_worker_request(state, {'command': 'shutdown'}).close()
+        except OSError:
+            pass
+        state = None
+
+    if state:
+        try:
+            return send_worker_request(state, request)
+        except OSError:
+            pass
+
+    QgsMessageLog.logMessage("Starting detection worker...", "TreeDetector", Qgis.Info)
+    state = spawn_worker(task, python_path, script_path)
+    if state is None:
+        return None
+    return send_worker_request(state, request)
+
+def await_worker(task, conn, timeout=WORKER_REPLY_TIMEOUT):
+    """Waits for the worker to accept the job; False if it is busy, gone or silent for `timeout` seconds."""
+    conn.settimeout(0.5)
+    deadline = time.monotonic() + timeout
+    reply = b""
+    while not reply.endswith(b"\n"):
+        if task.isCanceled() or time.monotonic() > deadline:
+            return False
+        try:
+            # A byte at a time, so that no protocol line is read past.
+            chunk = conn.recv(1)
+        except socket.timeout:
+            continue
+        if not chunk:
+            return False
+        reply += chunk
+    return reply.strip() == b"ACCEPTED"
+
+def worker_lines(task, conn):
+    """Yields protocol lines from a worker connection, polling for cancellation."""
+    conn.settimeout(0.5)
+    pending = []
+    while True:
+        try:
+            chunk = conn.recv(1 << 16)
+        except socket.timeout:
+            if task.isCanceled():
+                return
+            continue
+        if not chunk:
+            break
+        *complete, rest = chunk.split(b"\n")
+        for piece in complete:
+            pending.append(piece)
+            yield b"".join(pending).decode('utf-8')
+            pending = []
+        pending.append(rest)
+    if pending:
+        yield b"".join(pending).decode('utf-8')
+
+def run_worker_job(task, python_path, script_path, options, feed=None):
+    """Runs a detection job on the persistent worker, which keeps models loaded.
+
+    Falls back to a one-off external script if the worker cannot be reached
+    or does not accept the job, e.g. because another job is still running.
+    """
+    argv = build_script_args(options)
     try:
-        detections = json.loads(json_output)
-        return {'success': True, 'detections': detections}
-    except json.JSONDecodeError as e:
-        error_message = f"Failed to parse JSON from script output.\nError: {e}\nOutput: {json_output}"
+        conn = connect_worker(task, python_path, script_path, {'argv': argv})
+    except OSError as e:
+        QgsMessageLog.logMessage(f"Could not reach detection worker: {e}", "TreeDetector", Qgis.Warning)
+        conn = None
+    try:
+        accepted = conn is not None and await_worker(task, conn)
+    except OSError:
+        accepted = False
+    if conn and not accepted:
+        QgsMessageLog.logMessage("Detection worker is busy or not answering.", "TreeDetector", Qgis.Warning)
+        conn.close()
+        conn = None
+    if task.isCanceled():
+        if conn:
+            conn.close()
+        return {'success': False, 'error': 'Task Canceled'}
+    if conn is None:
+        QgsMessageLog.logMessage("Detection worker unavailable, running the external script instead.", "TreeDetector", Qgis.Warning)
+        return run_external_script(task, python_path, script_path, options, feed)
+
+    with conn:
+        output = consume_output(task, worker_lines(task, conn), feed)
+    if output is None:
+        return {'success': False, 'error': 'Task Canceled'}
+
+    status = output.pop() if output else ''
+    if status != 'DONE':
+        error_message = f"Detection worker failed: {status[len('ERROR:'):] if status.startswith('ERROR:') else 'connection closed'}"
         QgsMessageLog.logMessage(error_message, "TreeDetector", Qgis.Critical)
         return {'success': False, 'error': error_message}
 
+    return load_result(output)
+
 
 class TreeDetectorDialog(QDialog, Ui_TreeDetectorDialogBase):
     def __init__(self, iface, parent=None):
@@ -87,6 +473,120 @@ class TreeDetectorDialog(QDialog, Ui_TreeDetectorDialogBase):
         self.python_path_layout.addWidget(self.python_path_edit)
         self.python_path_layout.addWidget(self.python_path_button)
 
+        self.run_mode_combo = QComboBox()
+        self.run_mode_combo.addItem("Auto", "auto")
+        self.run_mode_combo.addItem("External Python", "external")
+        self.run_mode_combo.addItem("Inside QGIS", "in_process")
+        self.run_mode_combo.setToolTip("Auto runs small rasters inside QGIS when its Python has the model dependencies, and everything else in the external Python")
+        self.formLayout_2.addRow("Run Mode:", self.run_mode_combo)
+
+        self.backend_combo = QComboBox()
+        self.backend_combo.addItem("PyTorch", "torch")
+        self.backend_combo.addItem("ONNX Runtime", "onnx")
+        self.backend_combo.addItem("OpenVINO", "openvino")
+        self.backend_combo.setToolTip("ONNX Runtime and OpenVINO export the model on first use and are usually faster on CPU; boxes stay within about a pixel of PyTorch's")
+        self.formLayout_2.addRow("Inference Backend:", self.backend_combo)
+
+        self.int8_checkbox = QCheckBox("Quantize to INT8")
+        self.int8_checkbox.setToolTip("Dynamic INT8 quantization of the ONNX model: faster on CPU, with slightly looser boxes and confidences")
+        self.int8_checkbox.setEnabled(False)
+        self.backend_combo.currentIndexChanged.connect(
+            lambda: self.int8_checkbox.setEnabled(self.backend_combo.currentData() == 'onnx'))
+        self.formLayout_2.addRow("", self.int8_checkbox)
+
+        self.target_gsd_spin = QDoubleSpinBox()
+        self.target_gsd_spin.setRange(0, 10)
+        self.target_gsd_spin.setDecimals(3)
+        self.target_gsd_spin.setSingleStep(0.01)
+        self.target_gsd_spin.setSuffix(" m")
+        self.target_gsd_spin.setSpecialValueText("Auto")
+        self.target_gsd_spin.setToolTip("Ground resolution the model was trained at; finer rasters are read decimated to it, cutting tiles and I/O. Auto uses the \"gsd\" of a JSON file next to the model, if any")
+        self.formLayout_2.addRow("Model GSD:", self.target_gsd_spin)
+
+        self.batch_size_spin = QSpinBox()
+        self.batch_size_spin.setRange(1, 64)
+        self.batch_size_spin.setValue(8)
+        self.batch_size_spin.setToolTip("Number of 640x640 tiles sent to the model per inference call")
+        self.formLayout_2.addRow("Batch Size:", self.batch_size_spin)
+
+        self.aoi_layer_combo = QgsMapLayerComboBox()
+        self.aoi_layer_combo.setFilters(QgsMapLayerProxyModel.PolygonLayer)
+        self.aoi_layer_combo.setAllowEmptyLayer(True)
+        self.aoi_layer_combo.setLayer(None)
+        self.aoi_layer_combo.setToolTip("Only tiles intersecting these polygons are processed; detections outside them are dropped")
+        self.bands_edit = QLineEdit()
+        self.bands_edit.setPlaceholderText("1,2,3")
+        self.bands_edit.setToolTip("Red, green and blue band numbers fed to the model, e.g. 4,3,2; leave empty for the first three bands")
+        self.formLayout.addRow("Bands (R,G,B):", self.bands_edit)
+
+        self.extra_rasters_combo = QgsCheckableComboBox()
+        self.extra_rasters_combo.setDefaultText("None")
+        self.extra_rasters_combo.setToolTip("More raster layers processed in the same job, with one model load, into one merged result; they must share the input layer's CRS")
+        self.formLayout.addRow("Additional Rasters:", self.extra_rasters_combo)
+        self.refresh_extra_rasters()
+        QgsProject.instance().layersAdded.connect(self.refresh_extra_rasters)
+        QgsProject.instance().layersRemoved.connect(self.refresh_extra_rasters)
+
+        self.formLayout.addRow("Area of Interest:", self.aoi_layer_combo)
+
+        self.aoi_selected_checkbox = QCheckBox("Selected features only")
+        self.formLayout.addRow("", self.aoi_selected_checkbox)
+
+        self.aoi_extent_checkbox = QCheckBox("Limit to current map canvas extent")
+        self.formLayout.addRow("", self.aoi_extent_checkbox)
+
+        self.workers_spin = QSpinBox()
+        self.workers_spin.setRange(1, max(1, os.cpu_count() or 1))
+        self.workers_spin.setValue(1)
+        self.workers_spin.setToolTip("Number of processes the raster is split across, each with its own copy of the model")
+        self.formLayout_2.addRow("Worker Processes:", self.workers_spin)
+
+        self.gdal_threads_spin = QSpinBox()
+        self.gdal_threads_spin.setRange(0, max(1, os.cpu_count() or 1))
+        self.gdal_threads_spin.setSpecialValueText("Auto")
+        self.gdal_threads_spin.setToolTip("Threads GDAL uses to decode compressed raster blocks")
+        self.formLayout_2.addRow("GDAL Decode Threads:", self.gdal_threads_spin)
+
+        self.gdal_cache_spin = QSpinBox()
+        self.gdal_cache_spin.setRange(0, 65536)
+        self.gdal_cache_spin.setSingleStep(64)
+        self.gdal_cache_spin.setSuffix(" MB")
+        self.gdal_cache_spin.setSpecialValueText("Auto")
+        self.gdal_cache_spin.setToolTip("GDAL block cache; Auto sizes it to hold a strip of tiles across the raster")
+        self.formLayout_2.addRow("GDAL Cache:", self.gdal_cache_spin)
+
+        self.output_file_widget = QgsFileWidget()
+        self.output_file_widget.setStorageMode(QgsFileWidget.SaveFile)
+        self.output_file_widget.setFilter("GeoPackage (*.gpkg);;FlatGeobuf (*.fgb)")
+        self.output_file_widget.setToolTip("Write detections straight to this file and load it when done, instead of building a memory layer; leave empty for a memory layer")
+        self.formLayout_2.addRow("Output File:", self.output_file_widget)
+
+        self.output_boxes_checkbox = QCheckBox("Store box bounds as attributes")
+        self.output_boxes_checkbox.setToolTip("Adds xmin, ymin, xmax and ymax fields to the output file")
+        self.formLayout_2.addRow("", self.output_boxes_checkbox)
+
+        self.use_worker_checkbox = QCheckBox("Keep model loaded between runs")
+        self.use_worker_checkbox.setChecked(True)
+        self.use_worker_checkbox.setToolTip("Reuse a background detection worker instead of starting a new Python process for every run")
+        self.formLayout_2.addRow("", self.use_worker_checkbox)
+
+        self.resume_checkbox = QCheckBox("Save progress and resume interrupted runs")
+        self.resume_checkbox.setChecked(True)
+        self.resume_checkbox.setToolTip("Checkpoint finished tiles so that a canceled or crashed run with the same raster, model and thresholds picks up where it stopped")
+        self.formLayout_2.addRow("", self.resume_checkbox)
+
+        # Changing a threshold after a run re-filters the raw detections
+        # kept by that run instead of running the model again.
+        self.raw_index = None
+        self.result_layer = None
+        QgsProject.instance().layerWillBeRemoved.connect(self.result_layer_removed)
+        self.rethreshold_timer = QTimer(self)
+        self.rethreshold_timer.setSingleShot(True)
+        self.rethreshold_timer.setInterval(250)
+        self.rethreshold_timer.timeout.connect(self.apply_thresholds)
+        self.mDoubleSpinBox_confidence.valueChanged.connect(self.rethreshold_timer.start)
+        self.mDoubleSpinBox_iou.valueChanged.connect(self.rethreshold_timer.start)
+
         self.btn_start_detection.clicked.connect(self.start_external_process)
         self.button_box.rejected.connect(self.reject)
         
@@ -95,8 +595,7 @@ class TreeDetectorDialog(QDialog, Ui_TreeDetectorDialogBase):
 
     def auto_detect_python_path(self):
         # *** FIX: Read from a standard config location in the user's home directory ***
-        config_dir = os.path.join(os.path.expanduser("~"), ".tree_detector_plugin")
-        config_path = os.path.join(config_dir, 'config.txt')
+        config_path = os.path.join(CONFIG_DIR, 'config.txt')
         
         if os.path.exists(config_path):
             with open(config_path, 'r') as f:
@@ -133,6 +632,25 @@ class TreeDetectorDialog(QDialog, Ui_TreeDetectorDialogBase):
         if not os.path.exists(model_path):
             self.iface.messageBar().pushMessage("ผิดพลาด", f"ไม่พบไฟล์โมเดลที่: {model_path}", level=Qgis.Critical)
             return
+
+        aoi = self.collect_aoi(raster_layer.crs())
+        if aoi is not None and not aoi:
+            self.iface.messageBar().pushMessage("ผิดพลาด", "Area of Interest ไม่มี polygon ที่ใช้ได้", level=Qgis.Critical)
+            return
+
+        raster_layers = [raster_layer] + [layer for layer in self.checked_extra_rasters() if layer.id() != raster_layer.id()]
+        if any(layer.crs() != raster_layer.crs() for layer in raster_layers):
+            self.iface.messageBar().pushMessage("ผิดพลาด", "All rasters of a job must share one CRS; reproject them or build a VRT", level=Qgis.Critical)
+            return
+
+        output_path = self.output_file_widget.filePath().strip() or None
+        if output_path and os.path.splitext(output_path)[1].lower() not in ('.gpkg', '.fgb'):
+            output_path += '.gpkg'
+
+        if len(raster_layers) == 1 and self.use_in_process(raster_layer, model_path, aoi, output_path):
+            self.start_in_process(raster_layer, model_path, confidence, iou)
+            return
+
         if not os.path.exists(python_path):
             self.iface.messageBar().pushMessage("ผิดพลาด", f"ไม่พบ Python executable ที่: {python_path}", level=Qgis.Critical)
             return
@@ -140,67 +658,355 @@ class TreeDetectorDialog(QDialog, Ui_TreeDetectorDialogBase):
         self.label_status.setText("Status: กำลังเรียกใช้สคริปต์ภายนอก...")
         self.progressBar.setValue(0)
 
+        self.raw_index = None
+        self.file_text = ""
+        if output_path:
+            # Written and indexed by the script, then loaded as is.
+            self.result_layer = None
+            self.result_file = None
+            self.raw_file = None
+            self.appended_count = 0
+            self.throughput_text = ""
+        else:
+            self.start_result_layer(raster_layer.crs())
+            self.result_file = new_result_file()
+            self.raw_file = new_result_file('tree_raw_')
+        self.feed = ResultFeed()
+        self.feed.fileAnnounced.connect(self.result_file_announced)
+        self.feed.chunkReady.connect(self.append_result_chunk)
+        self.feed.telemetryReceived.connect(self.show_telemetry)
+        self.feed.fileStarted.connect(self.show_file_started)
+        self.aoi_file = write_aoi_file(aoi) if aoi else None
+
         self.task = QgsTask.fromFunction(
             'External Tree Detection',
-            run_external_script,
+            run_worker_job if self.use_worker_checkbox.isChecked() else run_external_script,
             on_finished=self.processing_finished,
             python_path=python_path,
             script_path=os.path.join(os.path.dirname(__file__), 'external_processor.py'),
-            input_raster=raster_layer.source(),
-            model_path=model_path,
-            confidence=confidence,
-            iou=iou
+            options={
+                'input': [layer.source() for layer in raster_layers],
+                'model': model_path,
+                'conf': confidence,
+                'iou': iou,
+                'target_gsd': self.target_gsd_spin.value() or None,
+                'batch_size': self.batch_size_spin.value(),
+                'workers': self.workers_spin.value(),
+                'gdal_threads': self.gdal_threads_spin.value(),
+                'gdal_cache': self.gdal_cache_spin.value(),
+                'result_file': self.result_file,
+                'bands': self.bands_edit.text().replace(' ', '') or None,
+                'raw_file': self.raw_file,
+                'aoi': self.aoi_file,
+                'resume': self.resume_checkbox.isChecked(),
+                'backend': self.backend_combo.currentData(),
+                'int8': self.int8_checkbox.isEnabled() and self.int8_checkbox.isChecked(),
+                'output': output_path,
+                'output_boxes': bool(output_path) and self.output_boxes_checkbox.isChecked()
+            },
+            feed=self.feed
         )
         self.task.progressChanged.connect(self.progressBar.setValue)
+        # Per-run state lives on the dialog, so runs must not overlap.
+        self.btn_start_detection.setEnabled(False)
         QgsApplication.taskManager().addTask(self.task)
 
-    def processing_finished(self, exception, result=None):
-        self.progressBar.setValue(100)
-        if exception:
-            self.iface.messageBar().pushMessage("ผิดพลาด", f"Task failed: {exception}", level=Qgis.Critical)
-            self.label_status.setText("Status: Error")
+    def use_in_process(self, raster_layer, model_path, aoi, output_path=None):
+        mode = self.run_mode_combo.currentData()
+        # Without a GSD in the dialog the script falls back to the model's sidecar.
+        target_gsd = self.target_gsd_spin.value() or model_gsd(model_path)
+        if mode == 'in_process':
+            if aoi is not None:
+                self.iface.messageBar().pushMessage("Warning", "Area of Interest is only applied in External Python mode; processing the whole raster.", level=Qgis.Warning, duration=5)
+            if output_path:
+                self.iface.messageBar().pushMessage("Warning", "Output files are only written in External Python mode; results go to a memory layer.", level=Qgis.Warning, duration=5)
+            if target_gsd:
+                self.iface.messageBar().pushMessage("Warning", "Target GSD is only applied in External Python mode; reading the raster at its native resolution.", level=Qgis.Warning, duration=5)
+            return True
+        if mode == 'external':
+            return False
+        # Auto: small rasters without an AOI, output file or GSD, when QGIS's Python can run the model.
+        if aoi is not None or output_path or target_gsd:
+            return False
+        pixels = raster_layer.width() * raster_layer.height()
+        return pixels <= IN_PROCESS_MAX_PIXELS and in_process_available()
+
+    def start_in_process(self, raster_layer, model_path, confidence, iou):
+        """Runs detection in a QGIS task, reading tiles from a clone of the layer's provider."""
+        bands = self.bands_edit.text().replace(' ', '')
+        try:
+            bands = band_list(bands) if bands else None
+        except argparse.ArgumentTypeError as e:
+            self.iface.messageBar().pushMessage("ผิดพลาด", f"Bands: {e}", level=Qgis.Critical)
             return
+        self.label_status.setText("Status: Running inside QGIS...")
+        self.progressBar.setValue(0)
 
-        if result is None or not result['success']:
-            error_msg = result.get('error', 'Unknown error in external script.') if result else 'Task did not return a result.'
+        self.start_result_layer(raster_layer.crs())
+        self.raw_index = None
+        self.task = QgsTask.fromFunction(
+            'Tree Detection',
+            run_in_process,
+            on_finished=self.in_process_finished,
+            provider=raster_layer.dataProvider().clone(),
+            model_path=model_path,
+            crs_wkt=raster_layer.crs().toWkt(),
+            conf_threshold=confidence,
+            iou_threshold=iou,
+            backend=self.backend_combo.currentData(),
+            int8=self.int8_checkbox.isEnabled() and self.int8_checkbox.isChecked(),
+            bands=bands
+        )
+        self.task.progressChanged.connect(self.progressBar.setValue)
+        self.btn_start_detection.setEnabled(False)
+        QgsApplication.taskManager().addTask(self.task)
+
+    def in_process_finished(self, exception, result=None):
+        self.progressBar.setValue(100)
+        self.btn_start_detection.setEnabled(True)
+        if exception or result is None or not result[0]:
+            error_msg = exception or (result[1] if result else 'Task did not return a result.')
             self.iface.messageBar().pushMessage("ผิดพลาด", f"การประมวลผลล้มเหลว: {error_msg}", level=Qgis.Critical)
             self.label_status.setText("Status: Failed")
+            QgsProject.instance().removeMapLayer(self.result_layer.id())
             return
-        
-        self.label_status.setText("Status: กำลังสร้าง Layer ผลลัพธ์...")
-        detections = result.get('detections', [])
-        self.display_results(detections)
 
-    def display_results(self, detections):
-        if not detections:
-            self.iface.messageBar().pushMessage("Info", "ไม่พบต้นไม้ในพื้นที่ที่เลือก")
-            self.label_status.setText("Status: Finished (No Detections)")
-            return
+        records, self.class_names = in_process_records(result[1])
+        self.add_detections(records)
+        self.display_results(len(records))
+
+    def collect_aoi(self, crs):
+        """Gathers the area-of-interest polygons in the raster CRS.
+
+        Returns None when the whole raster should be processed, otherwise a
+        list of geometries (empty if the chosen AOI has no usable polygons).
+        """
+        aoi_layer = self.aoi_layer_combo.currentLayer()
+        use_extent = self.aoi_extent_checkbox.isChecked()
+        if aoi_layer is None and not use_extent:
+            return None
+
+        geometries = []
+        if aoi_layer is not None:
+            transform = QgsCoordinateTransform(aoi_layer.crs(), crs, QgsProject.instance())
+            if self.aoi_selected_checkbox.isChecked():
+                features = aoi_layer.getSelectedFeatures()
+            else:
+                features = aoi_layer.getFeatures()
+            for feature in features:
+                geometry = QgsGeometry(feature.geometry())
+                if geometry.isEmpty():
+                    continue
+                geometry.transform(transform)
+                geometries.append(geometry)
 
-        source_crs = self.mMapLayerComboBox.currentLayer().crs()
-        vl = QgsVectorLayer(f"Point?crs={source_crs.authid()}", "Detections", "memory")
-        provider = vl.dataProvider()
+        if use_extent:
+            canvas = self.iface.mapCanvas()
+            extent = QgsGeometry.fromRect(canvas.extent())
+            extent.transform(QgsCoordinateTransform(canvas.mapSettings().destinationCrs(), crs, QgsProject.instance()))
+            if aoi_layer is None:
+                geometries = [extent]
+            else:
+                geometries = [g.intersection(extent) for g in geometries]
+                geometries = [g for g in geometries if not g.isEmpty()]
+        return geometries
+
+    def start_result_layer(self, crs):
+        """Creates the Detections layer up front so that results show up while the job runs.
+
+        The memory provider keeps a spatial index so that rendering,
+        selection and identify stay fast with millions of points.
+        """
+        self.result_layer = QgsVectorLayer(f"Point?crs={crs.authid()}&index=yes", "Detections", "memory")
+        provider = self.result_layer.dataProvider()
         provider.addAttributes([
             QgsField("confidence", QVariant.Double), 
             QgsField("class", QVariant.String)
         ])
-        vl.updateFields()
+        self.result_layer.updateFields()
+        self.result_dtype = None
+        self.class_names = {}
+        self.appended_count = 0
+        self.throughput_text = ""
+        QgsProject.instance().addMapLayer(self.result_layer)
 
-        for det in detections:
-            feature = QgsFeature()
-            coords = det['geometry']['coordinates']
-            point = QgsPointXY(coords[0], coords[1])
-            geom = QgsGeometry.fromPointXY(point)
-            
-            feature.setGeometry(geom)
-            feature.setAttributes([det['properties']['confidence'], det['properties']['class']])
-            provider.addFeature(feature)
-        
-        vl.updateExtents()
-        QgsProject.instance().addMapLayer(vl)
+    def result_file_announced(self, info):
+        self.result_dtype = result_dtype(info)
+        self.class_names = {int(k): v for k, v in info['classes'].items()}
+
+    def append_result_chunk(self, offset, count):
+        if self.result_dtype is None or offset != self.appended_count:
+            return
+        try:
+            records = read_result_records(self.result_file, self.result_dtype, offset, count)
+        except (OSError, ValueError):
+            return
+        self.add_detections(records)
+        del records
+        self.appended_count = offset + count
+        self.result_layer.updateExtents()
+        self.result_layer.triggerRepaint()
+        self.show_running_status()
+
+    def show_telemetry(self, telemetry):
+        if telemetry['final']:
+            self.throughput_text = ""
+        else:
+            eta = "" if telemetry['eta'] is None else f", ETA {format_duration(telemetry['eta'])}"
+            self.throughput_text = f" ({telemetry['tiles_per_second']:.1f} tiles/s{eta})"
+            self.show_running_status()
+
+    def show_file_started(self, index, count, path):
+        if count > 1:
+            self.file_text = f" raster {index + 1}/{count},"
+            self.show_running_status()
+
+    def show_running_status(self):
+        self.label_status.setText(f"Status: Running...{self.file_text} {self.appended_count} trees so far{self.throughput_text}")
+
+    def refresh_extra_rasters(self, *args):
+        """Lists the project's raster layers as candidates for a multi-raster job, keeping checked ones checked."""
+        checked = set(self.extra_rasters_combo.checkedItemsData())
+        self.extra_rasters_combo.clear()
+        for layer in QgsProject.instance().mapLayers().values():
+            if isinstance(layer, QgsRasterLayer):
+                self.extra_rasters_combo.addItemWithCheckState(
+                    layer.name(), Qt.Checked if layer.id() in checked else Qt.Unchecked, layer.id())
+
+    def checked_extra_rasters(self):
+        project = QgsProject.instance()
+        layers = [project.mapLayer(layer_id) for layer_id in self.extra_rasters_combo.checkedItemsData()]
+        return [layer for layer in layers if isinstance(layer, QgsRasterLayer)]
+
+    def add_detections(self, detections, block_size=65536):
+        """Adds detection records to the result layer in bulk.
+
+        Features are built from whole attribute arrays and handed to the
+        provider `block_size` at a time with a single addFeatures call.
+        """
+        provider = self.result_layer.dataProvider()
+        fields = self.result_layer.fields()
+        for start in range(0, len(detections), block_size):
+            block = detections[start:start + block_size]
+            xs = block['x'].tolist()
+            ys = block['y'].tolist()
+            confidences = block['confidence'].tolist()
+            classes = [self.class_names.get(class_id, str(class_id)) for class_id in block['class_id'].tolist()]
+
+            features = [QgsFeature(fields) for _ in range(len(xs))]
+            for feature, x, y, confidence, class_name in zip(features, xs, ys, confidences, classes):
+                feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+                feature.setAttributes([confidence, class_name])
+            provider.addFeatures(features)
+
+    def processing_finished(self, exception, result=None):
+        self.progressBar.setValue(100)
+        self.btn_start_detection.setEnabled(True)
+        try:
+            if exception:
+                self.iface.messageBar().pushMessage("ผิดพลาด", f"Task failed: {exception}", level=Qgis.Critical)
+                self.label_status.setText("Status: Error")
+                self.keep_partial_results()
+                return
+
+            if result is None or not result['success']:
+                error_msg = result.get('error', 'Unknown error in external script.') if result else 'Task did not return a result.'
+                self.iface.messageBar().pushMessage("ผิดพลาด", f"การประมวลผลล้มเหลว: {error_msg}", level=Qgis.Critical)
+                self.label_status.setText("Status: Failed")
+                self.keep_partial_results()
+                return
+
+            if 'output' in result:
+                self.load_output(result)
+                return
+
+            self.result_dtype = result['dtype']
+            self.class_names = result['class_names']
+            # Chunks whose signals have not been delivered yet are read here.
+            self.append_result_chunk(self.appended_count, result['count'] - self.appended_count)
+            self.display_results(result['count'])
+            if result['count'] > 0:
+                self.start_raw_index(self.raw_file)
+                self.raw_file = None
+        finally:
+            if self.raw_file:
+                remove_result_file(self.raw_file)
+            if self.result_file:
+                remove_result_file(self.result_file)
+            if self.aoi_file:
+                remove_result_file(self.aoi_file)
+
+    def load_output(self, result):
+        """Adds the GeoPackage or FlatGeobuf written by the script to the project."""
+        source = result['output'] if result['layer'] is None else f"{result['output']}|layername={result['layer']}"
+        layer = QgsVectorLayer(source, "Detections", "ogr")
+        if not layer.isValid():
+            self.iface.messageBar().pushMessage("ผิดพลาด", f"Could not load {result['output']}", level=Qgis.Critical)
+            self.label_status.setText("Status: Failed")
+            return
+        QgsProject.instance().addMapLayer(layer)
+        self.result_layer = layer
+        self.display_results(result['count'])
+
+    def start_raw_index(self, raw_path):
+        self.raw_task = QgsTask.fromFunction(
+            'Index raw tree detections',
+            build_raw_index,
+            on_finished=self.raw_index_ready,
+            raw_path=raw_path
+        )
+        QgsApplication.taskManager().addTask(self.raw_task)
+
+    def raw_index_ready(self, exception, result=None):
+        if exception or result is None:
+            QgsMessageLog.logMessage(f"Could not index raw detections: {exception}", "TreeDetector", Qgis.Warning)
+            return
+        self.raw_index = result
+
+    def result_layer_removed(self, layer_id):
+        """Forgets the Detections layer and its raw detections once it leaves the project."""
+        # Past this signal the layer object is deleted and unusable.
+        if self.result_layer is not None and layer_id == self.result_layer.id():
+            self.result_layer = None
+            self.raw_index = None
+
+    def apply_thresholds(self):
+        """Rebuilds the Detections layer from the raw detections at the current thresholds."""
+        if self.raw_index is None or self.result_layer is None:
+            return
+        index = self.raw_index
+        records = index['records']
+        candidates = records['confidence'] >= self.mDoubleSpinBox_confidence.value()
+        active = candidates[index['sources']] & candidates[index['targets']] & (index['ious'] > self.mDoubleSpinBox_iou.value())
+        kept = resolve_suppression(len(records), index['sources'][active], index['targets'][active], np, candidates)
+
+        detections = records[kept]
+        self.result_layer.dataProvider().truncate()
+        self.add_detections(detections)
+        self.result_layer.updateExtents()
+        self.result_layer.triggerRepaint()
+        self.label_status.setText(f"Status: Re-filtered, {len(detections)} trees.")
+
+    def keep_partial_results(self):
+        if self.result_layer is None:
+            return
+        if self.result_layer.featureCount() > 0:
+            self.result_layer.setName("Detections (partial)")
+        else:
+            QgsProject.instance().removeMapLayer(self.result_layer.id())
+
+    def display_results(self, count):
+        if count == 0:
+            QgsProject.instance().removeMapLayer(self.result_layer.id())
+            self.iface.messageBar().pushMessage("Info", "ไม่พบต้นไม้ในพื้นที่ที่เลือก")
+            self.label_status.setText("Status: Finished (No Detections)")
+            return
+
+        self.result_layer.updateExtents()
+        self.result_layer.triggerRepaint()
         self.iface.messageBar().pushMessage("สำเร็จ", "การตรวจจับเสร็จสิ้นและเพิ่ม Layer ใหม่แล้ว", level=Qgis.Success)
-        self.label_status.setText(f"Status: Finished! Found {len(detections)} trees.")
+        self.label_status.setText(f"Status: Finished! Found {count} trees.")
 
     def closingPlugin(self):
         if self.task and self.task.isRunning():
-            self.task.cancel()
\ No newline at end of file
+            self.task.cancel()